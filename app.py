@@ -1,27 +1,57 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file, abort, jsonify, flash
+from flask import Flask, render_template, request, redirect, url_for, send_file, abort, jsonify, flash, Response, \
+    g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.orm import selectinload
 from flask_caching import Cache
 from docxtpl import DocxTemplate, RichText
 from werkzeug.utils import secure_filename
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
+from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT, TA_JUSTIFY
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak, Table as PdfTable, TableStyle
+from docx.enum.text import WD_ALIGN_PARAGRAPH
+from docx.text.paragraph import Paragraph as DocxParagraph
+from docx.text.run import Run as DocxRun
+from docx.opc.constants import RELATIONSHIP_TYPE as RT
+from xml.sax.saxutils import escape as xml_escape
+from urllib.parse import urlencode
 from docx import Document
 from docx.shared import Inches, Pt
-from collections import defaultdict, Counter
+from jinja2 import Environment
+from collections import defaultdict, Counter, OrderedDict, namedtuple, deque
 import os
 import re
 import io
+import csv
 import uuid
-from datetime import datetime, timezone
+from datetime import datetime, date, timedelta, timezone
+from functools import lru_cache
+from types import SimpleNamespace
 from dateutil.parser import parse
 import pytz
 import logging
 import json
+import hashlib
+import base64
 import xml.etree.ElementTree as ET
-from zipfile import ZipFile
-import img2pdf
-from PIL import Image, ImageDraw, ImageFont
-import tempfile
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from contextvars import ContextVar
+from itertools import accumulate
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+import threading
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, BrokenExecutor, as_completed
+import time
+import random
+import cProfile
+import pstats
+try:
+    import fcntl
+except ImportError:  # Windows: sweeps aren't coordinated across processes
+    fcntl = None
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -30,19 +60,293 @@ app = Flask(__name__)
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 app.config.update(
     SECRET_KEY=os.environ.get('SECRET_KEY', 'dev-secret-key-change-in-production'),
-    SQLALCHEMY_DATABASE_URI=f'sqlite:///{os.path.join(BASE_DIR, "db", "app.db")}',
+    SQLALCHEMY_DATABASE_URI=os.environ.get('DATABASE_URL', f'sqlite:///{os.path.join(BASE_DIR, "db", "app.db")}'),
     UPLOAD_FOLDER=os.path.join(BASE_DIR, 'upload'),
     GENERATED_FOLDER=os.path.join(BASE_DIR, 'generated'),
     TEMP_FOLDER=os.path.join(BASE_DIR, 'temp'),
     ADMIN_KEY=os.environ.get('ADMIN_KEY', 'SecretAdmin123'),
     SQLALCHEMY_TRACK_MODIFICATIONS=False,
     MAX_CONTENT_LENGTH=16 * 1024 * 1024,  # 16MB max file size
-    CACHE_TYPE='SimpleCache',  # Change to 'RedisCache' for production if redis available
+    # Shared by all workers: files under CACHE_DIR by default, Redis when CACHE_REDIS_URL is set
+    CACHE_TYPE=os.environ.get('CACHE_TYPE', 'RedisCache' if os.environ.get('CACHE_REDIS_URL') else 'FileSystemCache'),
+    CACHE_DIR=os.environ.get('CACHE_DIR', os.path.join(BASE_DIR, 'temp', 'cache')),
+    CACHE_REDIS_URL=os.environ.get('CACHE_REDIS_URL'),
+    CACHE_DEFAULT_TIMEOUT=int(os.environ.get('CACHE_DEFAULT_TIMEOUT', 300)),
+    CACHE_THRESHOLD=int(os.environ.get('CACHE_THRESHOLD', 2000)),  # max entries for the file/simple backends
+    TEMPLATE_CACHE_MAX_ENTRIES=int(os.environ.get('TEMPLATE_CACHE_MAX_ENTRIES', 32)),
+    TEMPLATE_CACHE_MAX_BYTES=int(os.environ.get('TEMPLATE_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+    EPHEMERAL_GENERATION=os.environ.get('EPHEMERAL_GENERATION', 'true').lower() == 'true',
+    BACKGROUND_WORKERS=int(os.environ.get('BACKGROUND_WORKERS', 2)),
+    # Renders are CPU-bound Python (Jinja, lxml), so threads share one core under the GIL; processes
+    # only pay off with more than one CPU
+    BATCH_EXECUTOR=os.environ.get('BATCH_EXECUTOR', 'process' if (os.cpu_count() or 1) > 1 else 'thread'),
+    BATCH_WORKERS=int(os.environ.get('BATCH_WORKERS', 0)),  # 0 = default for the executor, set below
+    BATCH_JOB_WORKERS=int(os.environ.get('BATCH_JOB_WORKERS', 2)),
+    BATCH_PROGRESS_INTERVAL=float(os.environ.get('BATCH_PROGRESS_INTERVAL', 0.5)),  # seconds between progress writes
+    BATCH_STALE_SECONDS=int(os.environ.get('BATCH_STALE_SECONDS', 600)),  # a processing batch this quiet has lost its job
+    ZIP_COMPRESSION_LEVEL=int(os.environ.get('ZIP_COMPRESSION_LEVEL', 0)),  # 0 = stored, 1-9 = deflate level
+    FONT_DIRS=[d for d in os.environ.get('FONT_DIRS', '').split(os.pathsep) if d],  # searched before system dirs
+    ARTIFACT_CACHE_DIR=os.environ.get('ARTIFACT_CACHE_DIR', os.path.join(BASE_DIR, 'temp', 'artifacts')),
+    ARTIFACT_CACHE_MAX_BYTES=int(os.environ.get('ARTIFACT_CACHE_MAX_BYTES', 256 * 1024 * 1024)),  # 0 disables
+    SMART_RULES_FILE=os.environ.get('SMART_RULES_FILE', os.path.join(BASE_DIR, 'smart_rules.json')),
+    SNAPSHOT_CACHE_TTL=float(os.environ.get('SNAPSHOT_CACHE_TTL', 60)),  # seconds; bounds staleness across processes
+    SQLITE_JOURNAL_MODE=os.environ.get('SQLITE_JOURNAL_MODE', 'WAL').upper(),  # WAL lets readers run alongside a writer
+    SQLITE_SYNCHRONOUS=os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL').upper(),  # NORMAL is durable enough under WAL
+    SQLITE_BUSY_TIMEOUT=int(os.environ.get('SQLITE_BUSY_TIMEOUT', 15000)),  # ms to wait for the write lock
+    SQLITE_CACHE_SIZE_KB=int(os.environ.get('SQLITE_CACHE_SIZE_KB', 16384)),  # page cache per connection
+    DB_POOL_SIZE=int(os.environ.get('DB_POOL_SIZE', 10)),
+    DB_MAX_OVERFLOW=int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+    DB_POOL_RECYCLE=int(os.environ.get('DB_POOL_RECYCLE', 1800)),  # seconds; server databases only
+    ADMIN_STATS_TIMEOUT=int(os.environ.get('ADMIN_STATS_TIMEOUT', 60)),  # seconds the admin dashboard counts are cached
+    METRICS_ENABLED=os.environ.get('METRICS_ENABLED', 'true').lower() == 'true',  # Prometheus /metrics endpoint
+    SERVER_TIMING=os.environ.get('SERVER_TIMING', 'false').lower() == 'true',  # per-stage Server-Timing response header
+    PROFILE_DIR=os.environ.get('PROFILE_DIR', os.path.join(BASE_DIR, 'temp', 'profiles')),
+    PROFILE_SAMPLE_RATE=float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),  # fraction of requests profiled unasked
+    PROFILE_SLOW_SECONDS=float(os.environ.get('PROFILE_SLOW_SECONDS', 1.0)),  # sampled captures faster than this are dropped
+    PROFILE_KEEP=int(os.environ.get('PROFILE_KEEP', 100)),  # newest captures kept on disk
+    GENERATED_RETENTION_DAYS=float(os.environ.get('GENERATED_RETENTION_DAYS', 0)),  # 0 keeps documents forever
+    GENERATED_QUOTA_MB=int(os.environ.get('GENERATED_QUOTA_MB', 0)),  # 0 = no quota
+    STORAGE_SWEEP_INTERVAL=int(os.environ.get('STORAGE_SWEEP_INTERVAL', 3600)),  # seconds; 0 = only on demand
+    STORAGE_ORPHAN_GRACE=int(os.environ.get('STORAGE_ORPHAN_GRACE', 3600)),  # seconds before an unrecorded file is an orphan
 )
 
+if not app.config['BATCH_WORKERS']:
+    # One process per CPU; threads spend some time on disk I/O, so a few more of those
+    cpus = os.cpu_count() or 1
+    app.config['BATCH_WORKERS'] = cpus if app.config['BATCH_EXECUTOR'] == 'process' else min(32, cpus + 4)
+
+# Some hosts still hand out postgres:// URLs, which SQLAlchemy no longer accepts
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgres://'):
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql://' + app.config['SQLALCHEMY_DATABASE_URI'][len('postgres://'):]
+IS_SQLITE = app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite')
+
+# Engine tuning: SQLite waits for the write lock instead of failing with "database is locked"
+# (pragmas are set per connection below); server databases get a sized, self-healing pool
+if IS_SQLITE:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'connect_args': {'timeout': app.config['SQLITE_BUSY_TIMEOUT'] / 1000},
+    }
+    if app.config['SQLALCHEMY_DATABASE_URI'] not in ('sqlite://', 'sqlite:///:memory:'):
+        # File databases are pooled; in-memory ones use a single static connection
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(pool_size=app.config['DB_POOL_SIZE'],
+                                                       max_overflow=app.config['DB_MAX_OVERFLOW'])
+else:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': app.config['DB_POOL_SIZE'],
+        'max_overflow': app.config['DB_MAX_OVERFLOW'],
+        'pool_recycle': app.config['DB_POOL_RECYCLE'],
+        'pool_pre_ping': True,
+    }
+
 # Initialize caching
 cache = Cache(app)
 
+class CacheTags:
+    """Tag-based invalidation on top of the shared cache backend.
+
+    Every tag has a version token stored in the cache. Keys built with key() embed the
+    current tokens of their tags, so invalidating a tag orphans every entry built with
+    it, in every worker; orphaned entries age out through their own timeouts.
+    """
+
+    PREFIX = 'tag:'
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    def versions(self, tags):
+        keys = [self.PREFIX + tag for tag in tags]
+        versions = list(self.cache.get_many(*keys)) if keys else []
+        for i, key in enumerate(keys):
+            if versions[i] is None:
+                # Unknown or evicted tag: start from a fresh token, never an old one
+                self.cache.add(key, uuid.uuid4().hex, timeout=0)
+                versions[i] = self.cache.get(key)
+        return versions
+
+    def key(self, name, *tags):
+        return '|'.join([name] + [f'{tag}={version}' for tag, version in zip(tags, self.versions(tags))])
+
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.cache.set(self.PREFIX + tag, uuid.uuid4().hex, timeout=0)
+
+cache_tags = CacheTags(cache)
+
+# Instrumentation - per-stage timings as Prometheus histograms and an optional Server-Timing header
+class StageMetrics:
+    """Process-wide latency histogram with one series per stage, rendered in Prometheus text format."""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._series = {}  # stage -> [count per bucket..., count above the last bucket, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        index = bisect_left(self.BUCKETS, seconds)
+        with self._lock:
+            series = self._series.get(stage)
+            if series is None:
+                series = self._series[stage] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def render(self):
+        with self._lock:
+            snapshot = {stage: list(series) for stage, series in self._series.items()}
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for stage, series in sorted(snapshot.items()):
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + (None,), series[:-1]):
+                cumulative += count
+                le = '+Inf' if bound is None else f'{bound:g}'
+                lines.append(f'{self.name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{stage="{stage}"}} {series[-1]:.6f}')
+            lines.append(f'{self.name}_count{{stage="{stage}"}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+stage_metrics = StageMetrics('docgen_stage_duration_seconds', 'Time spent in each document generation stage.')
+
+# Set in pool workers, whose observations would otherwise stay in a worker process's registry
+_stage_collector = ContextVar('stage_collector', default=None)
+
+@contextmanager
+def timed(stage):
+    """Time a block into stage_metrics and, during a request, its Server-Timing header."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        collector = _stage_collector.get()
+        if collector is not None:
+            collector.append((stage, elapsed))
+        else:
+            stage_metrics.observe(stage, elapsed)
+        if has_request_context():
+            timings = g.setdefault('stage_timings', {})
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+@contextmanager
+def collect_stage_timings():
+    """Gather the timed() stages of a pool task into a list of (stage, seconds) for the caller to observe."""
+    timings = []
+    token = _stage_collector.set(timings)
+    try:
+        yield timings
+    finally:
+        _stage_collector.reset(token)
+
+def observe_stage_timings(timings):
+    """Record stage timings returned by a pool task in this process's stage_metrics."""
+    for stage, elapsed in timings:
+        stage_metrics.observe(stage, elapsed)
+
+# Request Profiling - opt-in cProfile captures of single requests, listed on /admin/profiles
+class RequestProfiler:
+    """Stores cProfile captures as <id>.prof with a <id>.json summary, keeping the newest `keep`.
+
+    Files rather than memory, so every worker's captures show up on the admin page.
+    """
+
+    ENDPOINTS = {'generate', 'batch', 'admin_upload_template'}
+    ID_PATTERN = re.compile(r'^[0-9a-f]{32}(-job)?$')
+
+    def __init__(self, directory, keep):
+        self.directory = directory
+        self.keep = keep
+
+    def trigger(self):
+        """Why the current request should be profiled ('header', 'query' or 'sample'), or None."""
+        if request.endpoint not in self.ENDPOINTS or request.method != 'POST':
+            return None
+        admin_key = app.config['ADMIN_KEY']
+        if request.headers.get('X-Profile') == admin_key:
+            return 'header'
+        if request.args.get('profile') == admin_key:
+            return 'query'
+        if random.random() < app.config['PROFILE_SAMPLE_RATE']:
+            return 'sample'
+        return None
+
+    @staticmethod
+    def start():
+        """An enabled profiler, or None if another one is already running in this thread."""
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            return None
+        return profiler
+
+    def save(self, profile_id, profiler, duration, **meta):
+        """Stop profiler and store it, unless it is a sampled capture faster than PROFILE_SLOW_SECONDS."""
+        profiler.disable()
+        if meta.get('trigger') == 'sample' and duration < app.config['PROFILE_SLOW_SECONDS']:
+            return
+        try:
+            profiler.dump_stats(os.path.join(self.directory, f'{profile_id}.prof'))
+            meta.update(id=profile_id, duration=duration, captured_at=datetime.now(timezone.utc).isoformat())
+            with open(os.path.join(self.directory, f'{profile_id}.json'), 'w') as f:
+                json.dump(meta, f)
+            self.prune()
+        except OSError as e:
+            logger.warning(f"Could not store profile {profile_id}: {e}")
+
+    @contextmanager
+    def capture(self, profile_id, **meta):
+        """Profile a block outside a request, such as a queued batch job."""
+        profiler = self.start()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                self.save(profile_id, profiler, time.perf_counter() - started, **meta)
+
+    def _summaries(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                yield entry
+
+    def prune(self):
+        entries = sorted(self._summaries(), key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in entries[self.keep:]:
+            for ext in ('.json', '.prof'):
+                try:
+                    os.remove(entry.path[:-len('.json')] + ext)
+                except FileNotFoundError:
+                    pass
+
+    def slowest(self):
+        """Summaries of the retained captures, slowest first."""
+        profiles = []
+        for entry in self._summaries():
+            try:
+                with open(entry.path) as f:
+                    profiles.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return sorted(profiles, key=lambda profile: profile['duration'], reverse=True)
+
+    def path(self, profile_id):
+        """Path of a stored .prof file; abort 404 for unknown or malformed ids."""
+        path = os.path.join(self.directory, f'{profile_id}.prof')
+        if not self.ID_PATTERN.match(profile_id) or not os.path.exists(path):
+            abort(404)
+        return path
+
+    def report(self, profile_id, limit=60):
+        """pstats text of the top functions by cumulative time."""
+        output = io.StringIO()
+        pstats.Stats(self.path(profile_id), stream=output).sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+request_profiler = RequestProfiler(app.config['PROFILE_DIR'], app.config['PROFILE_KEEP'])
+
 # Make 'json' available in all Jinja templates (for json.loads usage)
 app.jinja_env.globals['json'] = json
 
@@ -53,20 +357,45 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# West Africa Time, used for auto-filled and normalised dates
+LOCAL_TZ = pytz.timezone('Africa/Lagos')
+
 # Initialize database
 db = SQLAlchemy(app)
 
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """Apply journaling, durability and cache pragmas to each new SQLite connection."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA journal_mode={app.config['SQLITE_JOURNAL_MODE']}")
+    cursor.execute(f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS']}")
+    cursor.execute(f"PRAGMA busy_timeout={app.config['SQLITE_BUSY_TIMEOUT']}")
+    cursor.execute(f"PRAGMA cache_size=-{app.config['SQLITE_CACHE_SIZE_KB']}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.close()
+
+if IS_SQLITE:
+    with app.app_context():
+        event.listen(db.engine, 'connect', configure_sqlite_connection)
+
+# Background work (history persistence etc.) that must not hold up a response
+background_executor = ThreadPoolExecutor(max_workers=app.config['BACKGROUND_WORKERS'],
+                                         thread_name_prefix='background')
+
 # Ensure directories exist
 for folder in [app.config['UPLOAD_FOLDER'], app.config['GENERATED_FOLDER'],
-               app.config['TEMP_FOLDER'], os.path.join(BASE_DIR, 'db')]:
+               app.config['TEMP_FOLDER'], app.config['ARTIFACT_CACHE_DIR'], app.config['PROFILE_DIR'],
+               os.path.join(BASE_DIR, 'db')]:
     os.makedirs(folder, exist_ok=True)
 
 # Enhanced Database Models
 class Template(db.Model):
     __tablename__ = 'template'
+    __table_args__ = (
+        db.Index('ix_template_is_active_type', 'is_active', 'type'),  # active list, optionally by type
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
-    type = db.Column(db.String(50), nullable=False)
+    type = db.Column(db.String(50), nullable=False, index=True)
     file_path = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text)
     font_family = db.Column(db.String(50), default='Times New Roman')
@@ -76,8 +405,9 @@ class Template(db.Model):
     margin_left = db.Column(db.Float, default=1.0)
     margin_right = db.Column(db.Float, default=1.0)
     default_line_spacing = db.Column(db.Float, default=1.0)
+    form_schema = db.Column(db.Text)  # JSON list of form fields, one per placeholder base name
     is_active = db.Column(db.Boolean, default=True)
-    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)  # admin list order
     updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc),
                           onupdate=lambda: datetime.now(timezone.utc))
     placeholders = db.relationship('Placeholder', back_populates='template',
@@ -87,9 +417,13 @@ class Template(db.Model):
 
 class Placeholder(db.Model):
     __tablename__ = 'placeholder'
+    __table_args__ = (
+        db.Index('ix_placeholder_template_id_sort_order', 'template_id', 'sort_order'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     template_id = db.Column(db.Integer, db.ForeignKey('template.id'), nullable=False)
     name = db.Column(db.String(100), nullable=False)
+    base_name = db.Column(db.String(100))  # name without the _instance_N suffix
     display_name = db.Column(db.String(100))  # Human-readable name
     placeholder_type = db.Column(db.String(50), default='text')  # text, date, email, number, option
     is_required = db.Column(db.Boolean, default=False)
@@ -113,15 +447,16 @@ class Placeholder(db.Model):
 class CreatedDocument(db.Model):
     __tablename__ = 'created_document'
     id = db.Column(db.Integer, primary_key=True)
-    template_id = db.Column(db.Integer, db.ForeignKey('template.id'), nullable=False)
+    template_id = db.Column(db.Integer, db.ForeignKey('template.id'), nullable=False, index=True)
     user_name = db.Column(db.String(100), nullable=False)
     user_email = db.Column(db.String(100))
     file_path = db.Column(db.String(200), nullable=False)
     original_filename = db.Column(db.String(200))
     file_size = db.Column(db.Integer)
-    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
-    batch_id = db.Column(db.String(50), nullable=True)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+    batch_id = db.Column(db.String(50), nullable=True, index=True)
     user_inputs = db.Column(db.Text)  # JSON storage of inputs
+    artifact_key = db.Column(db.String(64))  # artifact cache entries rendered for this document
     template = db.relationship('Template', back_populates='created_documents')
 
 class BatchGeneration(db.Model):
@@ -135,205 +470,1025 @@ class BatchGeneration(db.Model):
     status = db.Column(db.String(20), default='pending')
     created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
     completed_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc),
+                           onupdate=lambda: datetime.now(timezone.utc))  # heartbeat while processing
     total_documents = db.Column(db.Integer, default=0)
     successful_documents = db.Column(db.Integer, default=0)
     error_message = db.Column(db.Text)
 
+# Immutable, picklable copies of a Template and its placeholders for DB-free rendering
+PlaceholderSnapshot = namedtuple('PlaceholderSnapshot', [c.name for c in Placeholder.__table__.columns])
+TemplateSnapshot = namedtuple('TemplateSnapshot', [c.name for c in Template.__table__.columns] + ['placeholders'])
+
+def snapshot_template(template):
+    """Detach a Template and its placeholders from the session so workers never touch the DB."""
+    placeholders = tuple(
+        PlaceholderSnapshot(**{f: getattr(ph, f) for f in PlaceholderSnapshot._fields})
+        for ph in template.placeholders
+    )
+    fields = {f: getattr(template, f) for f in TemplateSnapshot._fields if f != 'placeholders'}
+    return TemplateSnapshot(placeholders=placeholders, **fields)
+
+# Template data access - templates are read with their placeholders in one IN query and
+# served as immutable snapshots from a read-through cache
+class SnapshotCache:
+    """Process-wide read-through cache of TemplateSnapshots by template id.
+
+    Misses for any number of ids are loaded together: one query for the templates and
+    one selectin query for all their placeholders. Each entry remembers the template's
+    cache tag version, so an edit made by any worker is seen on the next lookup; the
+    TTL only covers changes made outside the app.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}  # template_id -> (loaded_at, tag version, TemplateSnapshot)
+        self._generation = 0  # bumped on invalidation so in-flight loads don't store stale rows
+        self._lock = threading.Lock()
+
+    def get_many(self, template_ids):
+        """Return {template_id: TemplateSnapshot} for the ids that exist; ids may be ints or digit strings."""
+        with timed('template_lookup'):
+            return self._get_many(template_ids)
+
+    def _get_many(self, template_ids):
+        ids = list({int(tid) for tid in template_ids if str(tid).isdigit()})
+        versions = dict(zip(ids, cache_tags.versions([f'template:{template_id}' for template_id in ids])))
+        now = time.monotonic()
+        snapshots, missing = {}, []
+        for template_id in ids:
+            entry = self._entries.get(template_id)
+            if entry is not None and now - entry[0] < self.ttl and entry[1] == versions[template_id]:
+                snapshots[template_id] = entry[2]
+            else:
+                missing.append(template_id)
+
+        if missing:
+            generation = self._generation
+            loaded = {
+                template.id: snapshot_template(template)
+                for template in Template.query.options(selectinload(Template.placeholders))
+                                              .filter(Template.id.in_(missing))
+            }
+            snapshots.update(loaded)
+            with self._lock:
+                if generation == self._generation:
+                    self._entries.update((template_id, (now, versions[template_id], snapshot))
+                                         for template_id, snapshot in loaded.items())
+        return snapshots
+
+    def get(self, template_id):
+        return self.get_many([template_id]).get(int(template_id))
+
+    def get_or_404(self, template_id):
+        snapshot = self.get(template_id)
+        if snapshot is None:
+            abort(404)
+        return snapshot
+
+    def invalidate(self, template_id):
+        with self._lock:
+            self._generation += 1
+            self._entries.pop(template_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+snapshot_cache = SnapshotCache(app.config['SNAPSHOT_CACHE_TTL'])
+
+# Compiled Template Cache
+class CompiledTemplate:
+    """A DOCX template with its body, header and footer XML pre-patched and pre-compiled."""
+
+    _jinja_env = Environment()
+
+    def __init__(self, template_id, key, docx_bytes):
+        self.template_id = template_id
+        self.key = key
+        self.docx_bytes = docx_bytes
+        self.parts = {}  # relKey -> (compiled jinja template, encoding)
+        self.notes = {}  # relKey -> compiled jinja template, for footnotes/endnotes
+
+        tpl = DocxTemplate(io.BytesIO(docx_bytes))
+        tpl.init_docx()
+        body_src = self._prepare_source(tpl.patch_xml(tpl.get_xml()))
+        self.body = self._jinja_env.from_string(body_src)
+        self.size = len(docx_bytes) + len(body_src)
+
+        for uri in (DocxTemplate.HEADER_URI, DocxTemplate.FOOTER_URI):
+            for rel_key, part in tpl.get_headers_footers(uri):
+                xml = tpl.get_part_xml(part)
+                encoding = tpl.get_headers_footers_encoding(xml)
+                part_src = self._prepare_source(tpl.patch_xml(xml))
+                self.parts[rel_key] = (self._jinja_env.from_string(part_src), encoding)
+                self.size += len(part_src)
+
+        # docxtpl leaves footnotes and endnotes alone; render them too so their placeholders work
+        for rel_key, rel in tpl.docx.part.rels.items():
+            if rel.reltype in (RT.FOOTNOTES, RT.ENDNOTES) and not rel.is_external:
+                part_src = self._prepare_source(tpl.patch_xml(tpl.get_part_xml(rel.target_part)))
+                self.notes[rel_key] = self._jinja_env.from_string(part_src)
+                self.size += len(part_src)
+
+    @staticmethod
+    def _prepare_source(src_xml):
+        # Same line splitting docxtpl applies before compiling, so error line numbers match
+        return re.sub(r'<w:p([ >])', r'\n<w:p\1', src_xml)
+
+    def new_document(self):
+        """Return a fresh, renderable document backed by this compiled template."""
+        return CompiledDocxTemplate(self)
+
+class CompiledDocxTemplate(DocxTemplate):
+    """DocxTemplate that renders from a CompiledTemplate instead of re-compiling its XML."""
+
+    def __init__(self, compiled):
+        super().__init__(io.BytesIO(compiled.docx_bytes))
+        self.compiled = compiled
+
+    def _render_compiled(self, part, compiled_template, context):
+        self.current_rendering_part = part
+        dst_xml = compiled_template.render(context)
+        dst_xml = re.sub(r'\n<w:p([ >])', r'<w:p\1', dst_xml)
+        dst_xml = (dst_xml
+                   .replace('{_{', '{{')
+                   .replace('}_}', '}}')
+                   .replace('{_%', '{%')
+                   .replace('%_}', '%}'))
+        return self.resolve_listing(dst_xml)
+
+    def build_xml(self, context, jinja_env=None):
+        return self._render_compiled(self.docx._part, self.compiled.body, context)
+
+    def build_headers_footers_xml(self, context, uri, jinja_env=None):
+        for rel_key, part in self.get_headers_footers(uri):
+            compiled_template, encoding = self.compiled.parts[rel_key]
+            yield rel_key, self._render_compiled(part, compiled_template, context).encode(encoding)
+
+    def render(self, context, jinja_env=None, autoescape=False):
+        super().render(context, jinja_env, autoescape)
+        for rel_key, compiled_template in self.compiled.notes.items():
+            part = self.docx.part.rels[rel_key].target_part
+            xml = self._render_compiled(part, compiled_template, context)
+            # Notes parts are loaded as plain blob parts
+            part._blob = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n' + xml).encode('utf-8')
+
+class TemplateCache:
+    """Process-wide LRU cache of compiled templates, bounded by entry count and size."""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # template_id -> CompiledTemplate
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(template, file_path):
+        return (template.updated_at, template.file_path, os.path.getmtime(file_path))
+
+    def get(self, template):
+        """Return the compiled form of a Template, compiling it on a miss or when stale."""
+        file_path = os.path.join(app.config['UPLOAD_FOLDER'], template.file_path)
+        key = self.cache_key(template, file_path)
+        with self._lock:
+            compiled = self._entries.get(template.id)
+            if compiled is not None and compiled.key == key:
+                self._entries.move_to_end(template.id)
+                return compiled
+
+        with timed('template_compile'), open(file_path, 'rb') as f:
+            compiled = CompiledTemplate(template.id, key, f.read())
+        logger.info(f"Compiled template {template.id} ({compiled.size} bytes)")
+
+        with self._lock:
+            self._discard(template.id)
+            if compiled.size <= self.max_bytes:
+                self._entries[template.id] = compiled
+                self._total_bytes += compiled.size
+                while len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._total_bytes -= evicted.size
+        return compiled
+
+    def invalidate(self, template_id):
+        with self._lock:
+            self._discard(template_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def _discard(self, template_id):
+        compiled = self._entries.pop(template_id, None)
+        if compiled is not None:
+            self._total_bytes -= compiled.size
+
+template_cache = TemplateCache(app.config['TEMPLATE_CACHE_MAX_ENTRIES'],
+                               app.config['TEMPLATE_CACHE_MAX_BYTES'])
+
+def invalidate_template(template_id):
+    """Drop every in-process cached form of a template after it changes."""
+    snapshot_cache.invalidate(template_id)
+    template_cache.invalidate(template_id)
+    cache_tags.invalidate('templates', f'template:{template_id}')
+
+# Artifact Cache - rendered outputs addressed by what they were rendered from
+class ArtifactCache:
+    """Content-addressed, size-bounded on-disk cache of rendered DOCX and PDF bytes.
+
+    Keys hash the template id and version with the normalized inputs, so an edited
+    template simply stops matching its old entries, which then age out. Entries are
+    evicted least-recently-used once the directory exceeds max_bytes. Every worker
+    process shares the directory, so each one's index of it is re-read from disk at
+    least every RESCAN_SECONDS and again before evicting.
+    """
+
+    # Part of every key; bump it to orphan entries written by older code (version 1 could hold
+    # placeholder PDFs from failed conversions)
+    VERSION = 2
+    RESCAN_SECONDS = 30
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries = None  # file name -> size, least recently used first
+        self._total_bytes = 0
+        self._scanned_at = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(template, user_inputs):
+        """Hash of template id/version and the inputs the template actually uses."""
+        inputs = {}
+        has_blank_date = False
+        for ph in template.placeholders:
+            value = str(user_inputs.get(ph.base_name, ''))
+            inputs[ph.base_name] = value
+            if ph.placeholder_type == 'date' and not value.strip():
+                has_blank_date = True
+        updated_at = template.updated_at.isoformat() if template.updated_at else ''
+        payload = [ArtifactCache.VERSION, template.id, updated_at, template.file_path, inputs]
+        if has_blank_date:
+            # Blank dates render as today, so the output is only valid for today
+            payload.append(datetime.now(LOCAL_TZ).date().isoformat())
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _load(self, rescan=False):
+        if rescan or self._entries is None or time.monotonic() - self._scanned_at > self.RESCAN_SECONDS:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.is_file() and not entry.name.endswith('.tmp'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+            self._entries = OrderedDict((name, size) for _, name, size in sorted(entries))
+            self._total_bytes = sum(self._entries.values())
+            self._scanned_at = time.monotonic()
+
+    def get(self, key, ext):
+        """Return cached bytes for key and extension, or None."""
+        if not self.enabled:
+            return None
+        name = f"{key}.{ext}"
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        with self._lock:
+            self._load()
+            if name in self._entries:
+                self._entries.move_to_end(name)
+        try:
+            os.utime(path)  # keep on-disk order meaningful across restarts
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, ext, data):
+        """Store bytes under key and extension, evicting old entries to stay under max_bytes."""
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        name = f"{key}.{ext}"
+        path = os.path.join(self.directory, name)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not cache artifact {name}: {str(e)}")
+            return
+
+        with self._lock:
+            self._load()
+            self._total_bytes -= self._entries.pop(name, 0)
+            self._entries[name] = len(data)
+            self._total_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self._load(rescan=True)  # other processes' writes and evictions
+            while self._total_bytes > self.max_bytes and self._entries:
+                evicted, size = self._entries.popitem(last=False)
+                self._total_bytes -= size
+                try:
+                    os.remove(os.path.join(self.directory, evicted))
+                except OSError:
+                    pass
+
+    def discard(self, key):
+        """Remove the DOCX and PDF cached under key, e.g. when the document they belong to is deleted."""
+        if not key:
+            return
+        with self._lock:
+            for ext in ('docx', 'pdf'):
+                name = f"{key}.{ext}"
+                if self._entries is not None:
+                    self._total_bytes -= self._entries.pop(name, 0)
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+    def clear(self):
+        with self._lock:
+            for entry in os.scandir(self.directory):
+                if entry.is_file():
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+            self._entries = OrderedDict()
+            self._total_bytes = 0
+
+artifact_cache = ArtifactCache(app.config['ARTIFACT_CACHE_DIR'], app.config['ARTIFACT_CACHE_MAX_BYTES'])
+
+# Font Registry - TrueType fonts for the PDF engine
+class FontRegistry:
+    """Process-wide registry of TrueType fonts.
+
+    System font directories are scanned once, Word family names are resolved to files
+    with fallbacks to metric-compatible families, and each resolved (family, style) is
+    registered with ReportLab once. Families with no usable file fall back to the PDF
+    base fonts.
+    """
+
+    SYSTEM_FONT_DIRS = [
+        '/usr/share/fonts', '/usr/local/share/fonts', os.path.expanduser('~/.fonts'),
+        os.path.expanduser('~/.local/share/fonts'), '/Library/Fonts', '/System/Library/Fonts',
+        os.path.join(os.environ.get('WINDIR', 'C:\\Windows'), 'Fonts'),
+    ]
+
+    # Metric-compatible or look-alike substitutes, tried in order
+    FALLBACKS = {
+        'timesnewroman': ['times', 'liberationserif', 'tinos', 'dejavuserif'],
+        'times': ['timesnewroman', 'liberationserif', 'tinos', 'dejavuserif'],
+        'georgia': ['gelasio', 'liberationserif', 'dejavuserif'],
+        'cambria': ['caladea', 'liberationserif', 'dejavuserif'],
+        'arial': ['helvetica', 'liberationsans', 'arimo', 'dejavusans'],
+        'helvetica': ['arial', 'liberationsans', 'arimo', 'dejavusans'],
+        'calibri': ['carlito', 'liberationsans', 'dejavusans'],
+        'verdana': ['dejavusans', 'liberationsans'],
+        'tahoma': ['dejavusans', 'liberationsans'],
+        'couriernew': ['courier', 'liberationmono', 'cousine', 'dejavusansmono'],
+        'courier': ['couriernew', 'liberationmono', 'cousine', 'dejavusansmono'],
+    }
+
+    # Windows ships fonts under short file names
+    WINDOWS_FILES = {
+        'arial': ('arial', ''), 'arialbd': ('arial', 'bold'), 'ariali': ('arial', 'italic'),
+        'arialbi': ('arial', 'bolditalic'),
+        'times': ('timesnewroman', ''), 'timesbd': ('timesnewroman', 'bold'),
+        'timesi': ('timesnewroman', 'italic'), 'timesbi': ('timesnewroman', 'bolditalic'),
+        'cour': ('couriernew', ''), 'courbd': ('couriernew', 'bold'), 'couri': ('couriernew', 'italic'),
+        'courbi': ('couriernew', 'bolditalic'),
+        'calibri': ('calibri', ''), 'calibrib': ('calibri', 'bold'), 'calibrii': ('calibri', 'italic'),
+        'calibriz': ('calibri', 'bolditalic'),
+        'georgia': ('georgia', ''), 'georgiab': ('georgia', 'bold'), 'georgiai': ('georgia', 'italic'),
+        'georgiaz': ('georgia', 'bolditalic'),
+        'verdana': ('verdana', ''), 'verdanab': ('verdana', 'bold'), 'verdanai': ('verdana', 'italic'),
+        'verdanaz': ('verdana', 'bolditalic'),
+    }
+
+    def __init__(self, extra_dirs=None):
+        self.font_dirs = list(extra_dirs or []) + self.SYSTEM_FONT_DIRS
+        self._files = None  # family key -> {style: path}
+        self._resolved = {}  # (family key, style) -> ReportLab font name
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def family_key(family):
+        return re.sub(r'[^a-z0-9]', '', (family or '').lower())
+
+    @staticmethod
+    def style_key(bold, italic):
+        return ('bold' if bold else '') + ('italic' if italic else '')
+
+    def _scan(self):
+        """Index every .ttf under the font directories by family and style (filename based)."""
+        files = defaultdict(dict)
+        for font_dir in self.font_dirs:
+            for root, _, names in os.walk(font_dir):
+                for name in names:
+                    stem, ext = os.path.splitext(name)
+                    if ext.lower() != '.ttf':
+                        continue
+                    parsed = self._parse_file_name(stem)
+                    if parsed is not None:
+                        family, style = parsed
+                        files[family].setdefault(style, os.path.join(root, name))
+        logger.info(f"Font registry indexed {sum(len(v) for v in files.values())} fonts in {len(files)} families")
+        return files
+
+    def _parse_file_name(self, stem):
+        key = stem.lower()
+        if key in self.WINDOWS_FILES:
+            return self.WINDOWS_FILES[key]
+        family, _, style = stem.partition('-')
+        if not style:
+            words = stem.split(' ')
+            family, style = words[0], ' '.join(words[1:])
+            for i, word in enumerate(words):
+                if word.lower() in ('regular', 'bold', 'italic', 'oblique'):
+                    family, style = ' '.join(words[:i]), ' '.join(words[i:])
+                    break
+        style = style.lower().replace(' ', '')
+        bold = 'bold' in style
+        italic = 'italic' in style or 'oblique' in style
+        # Skip other weights (light, medium, condensed...) rather than misfile them as regular
+        leftover = style.replace('bold', '').replace('italic', '').replace('oblique', '').replace('regular', '')
+        if leftover:
+            return None
+        return self.family_key(family), self.style_key(bold, italic)
+
+    def pdf_font(self, family, bold=False, italic=False):
+        """Return a ReportLab font name for a Word font family and style, registering it on first use."""
+        key = (self.family_key(family), self.style_key(bold, italic))
+        font_name = self._resolved.get(key)
+        if font_name is not None:
+            return font_name
+
+        with self._lock:
+            if key not in self._resolved:
+                self._resolved[key] = self._resolve(family, *key)
+            return self._resolved[key]
+
+    def _resolve(self, family, family_key, style):
+        if self._files is None:
+            self._files = self._scan()
+        for candidate in [family_key] + self.FALLBACKS.get(family_key, []):
+            path = self._files.get(candidate, {}).get(style)
+            if path is None:
+                continue
+            font_name = f"{candidate}-{style or 'regular'}"
+            try:
+                if font_name not in pdfmetrics.getRegisteredFontNames():
+                    pdfmetrics.registerFont(TTFont(font_name, path))
+                return font_name
+            except Exception as e:
+                logger.warning(f"Could not load font {path}: {str(e)}")
+        base_font = self._base_font(family_key, 'bold' in style, 'italic' in style)
+        logger.warning(f"No TrueType font for '{family}' ({style or 'regular'}), using {base_font}")
+        return base_font
+
+    @staticmethod
+    def _base_font(family_key, bold, italic):
+        """Map a family onto one of the PDF base fonts."""
+        if any(x in family_key for x in ['courier', 'mono', 'consolas']):
+            styles = ['Courier', 'Courier-Bold', 'Courier-Oblique', 'Courier-BoldOblique']
+        elif any(x in family_key for x in ['arial', 'helvetica', 'calibri', 'verdana', 'tahoma', 'sans']):
+            styles = ['Helvetica', 'Helvetica-Bold', 'Helvetica-Oblique', 'Helvetica-BoldOblique']
+        else:
+            styles = ['Times-Roman', 'Times-Bold', 'Times-Italic', 'Times-BoldItalic']
+        return styles[(1 if bold else 0) + (2 if italic else 0)]
+
+font_registry = FontRegistry(app.config['FONT_DIRS'])
+
+# Smart Field Rules - placeholder type, default, help text and options inferred from its name
+SmartField = namedtuple('SmartField', ['type', 'default', 'help_text', 'options'])
+
+
+class SmartFieldRules:
+    """Keyword rule table for the smart placeholder heuristics.
+
+    Each field has an ordered list of (keywords, value) rules; the first rule with a
+    keyword contained in the lowercased name wins. Every keyword of every field is
+    compiled into one regex, so a single scan of the name resolves all four fields.
+    Results are memoised by name. Rules from the JSON file at SMART_RULES_FILE (same
+    shape as BUILTIN_RULES) take precedence over the built-in ones and are reloaded
+    when the file changes; a file that isn't valid is logged and ignored.
+    """
+
+    FIELDS = ('type', 'default', 'help_text', 'options')
+
+    BUILTIN_RULES = {
+        'type': [
+            (['date'], 'date'),
+            (['email'], 'email'),
+            (['number', 'amount', 'reg_no'], 'number'),
+            (['url'], 'url'),
+            (['gender', 'relation', 'he_she', 'his_her', 'relationship', 'religion', 'level'], 'option'),
+        ],
+        'default': [
+            # Name variations - ALL POSSIBLE FORMATS
+            (['name', 'full_name', 'student_name', 'applicant_name', 'name_1'], "Joe Doe"),
+            # Address variations - ALL POSSIBLE FORMATS
+            (['address', 'sender_address', 'my_address', 'location', 'residence'],
+             "24 Avenue Avenue, Osato Junction, Benin City, Edo State"),
+            (['street'], "24 Avenue Avenue"),
+            (['city', 'town'], "Benin City"),
+            (['state'], "Edo State"),
+            # Department/Faculty variations
+            (['department', 'dept'], "Production Engineering"),
+            (['faculty'], "Engineering"),
+            (['college', 'institution', 'university', 'school'], "University of Benin"),
+            # Academic info - ALL FORMATS
+            (['mat_no', 'matric_no', 'reg_no', 'student_id', 'registration_number'], "ENG2204223"),
+            # Gender variations - ALL FORMATS
+            (['gender'], "Male"),
+            (['his_her', 'his_she'], "his"),
+            (['him_her', 'him_she'], "him"),
+            (['he_she', 'heshe'], "he"),
+            # Dates - NO PLACEHOLDER (auto-filled)
+            (['date', 'time'], ""),
+        ],
+        'help_text': [
+            (['name', 'full_name'], "Enter your full name (e.g., John Smith)"),
+            (['address'], "Enter your full address separated by commas"),
+            (['department'], "Enter your department name"),
+            (['faculty'], "Enter your faculty name"),
+            (['mat_no', 'reg_no', 'jamb_reg_no'], "Enter your matriculation/registration number"),
+            (['date'], "Leave blank for current date or enter custom date"),
+            (['gender'], "Select your gender"),
+            (['email'], "Enter your email address"),
+        ],
+        'options': [
+            (['gender'], ["Male", "Female"]),
+            (['his_her'], ["his", "her"]),
+            (['him_her'], ["him", "her"]),
+            (['he_she'], ["he", "she"]),
+            (['religion'], ["Christian", "Muslim"]),
+            (['relationship', 'relation'], ["son", "daughter", "niece", "nephew", "brother", "sister"]),
+        ],
+    }
+
+    MAX_MEMO_ENTRIES = 4096
+    NO_RULE = float('inf')
+
+    def __init__(self, rules_file=None):
+        self.rules_file = rules_file
+        self._lock = threading.Lock()
+        self._file_mtime = None
+        self._compile(self.BUILTIN_RULES)
+        self.refresh()
+
+    def _compile(self, *rule_sets):
+        """Build the combined regex and, per keyword, the winning rule index for each field."""
+        priority = {}  # keyword -> {field: rule index}
+        values = {field: [] for field in self.FIELDS}
+        for rules in rule_sets:
+            for field in self.FIELDS:
+                for keywords, value in rules.get(field, []):
+                    index = len(values[field])
+                    values[field].append(value)
+                    for keyword in keywords:
+                        priority.setdefault(keyword.lower(), {}).setdefault(field, index)
+
+        keywords = sorted(priority, key=len, reverse=True)
+        # A keyword matched at some position implies every keyword it contains is present too,
+        # so fold those into one tuple of winning rule indices per field
+        winners = {}
+        for keyword in keywords:
+            implied = [priority[other] for other in keywords if other in keyword]
+            winners[keyword] = tuple(min(p.get(field, self.NO_RULE) for p in implied) for field in self.FIELDS)
+        # Zero-width lookahead finds the longest keyword at every position, overlaps included
+        pattern = re.compile('(?=(' + '|'.join(map(re.escape, keywords)) + '))') if keywords else None
+        # Swapped in as one tuple so concurrent lookups never mix old and new rules
+        self._state = (pattern, winners, values, {})
+
+    @classmethod
+    def validate(cls, rules):
+        """Raise ValueError unless rules has the shape {field: [[[keyword, ...], value], ...]}."""
+        if not isinstance(rules, dict):
+            raise ValueError("rules must be an object keyed by field")
+        for field, field_rules in rules.items():
+            if field not in cls.FIELDS:
+                raise ValueError(f"unknown field '{field}', expected one of {', '.join(cls.FIELDS)}")
+            if not isinstance(field_rules, list):
+                raise ValueError(f"'{field}' must be a list of [keywords, value] rules")
+            for number, rule in enumerate(field_rules, 1):
+                if not isinstance(rule, (list, tuple)) or len(rule) != 2:
+                    raise ValueError(f"'{field}' rule {number} must be a [keywords, value] pair")
+                keywords, value = rule
+                # A bare string would be read one character at a time and match nearly every name
+                if not isinstance(keywords, (list, tuple)) or not keywords or \
+                        not all(isinstance(k, str) and k for k in keywords):
+                    raise ValueError(f"'{field}' rule {number} keywords must be a non-empty list of strings")
+                if field == 'options':
+                    if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+                        raise ValueError(f"'options' rule {number} value must be a list of strings")
+                elif not isinstance(value, str):
+                    raise ValueError(f"'{field}' rule {number} value must be a string")
+
+    def refresh(self):
+        """Reload admin rules if the rules file was added, changed or removed."""
+        try:
+            mtime = os.path.getmtime(self.rules_file) if self.rules_file else None
+        except OSError:
+            mtime = None
+        if mtime == self._file_mtime:
+            return
+        with self._lock:
+            if mtime == self._file_mtime:
+                return
+            custom = {}
+            if mtime is not None:
+                try:
+                    with open(self.rules_file, encoding='utf-8') as f:
+                        custom = json.load(f)
+                    self.validate(custom)
+                    logger.info(f"Loaded smart field rules from {self.rules_file}")
+                except (OSError, ValueError) as e:
+                    logger.error(f"Ignoring invalid smart field rules file {self.rules_file}: {str(e)}")
+                    custom = {}
+            self._compile(custom, self.BUILTIN_RULES)
+            self._file_mtime = mtime
+
+    def resolve(self, var_name):
+        """Return the SmartField for a placeholder name; options are only given to option fields."""
+        pattern, winners, values, memo = self._state
+        field = memo.get(var_name)
+        if field is not None:
+            return field
+
+        best = None
+        if pattern is not None:
+            for match in pattern.finditer(var_name.lower()):
+                found = winners[match.group(1)]
+                best = found if best is None else tuple(map(min, best, found))
+        resolved = {}
+        if best is not None:
+            resolved = {name: values[name][index] for name, index in zip(self.FIELDS, best)
+                        if index != self.NO_RULE}
+
+        title = var_name.replace('_', ' ').title()
+        var_type = resolved.get('type', 'text')
+        field = SmartField(
+            type=var_type,
+            default=resolved['default'] if 'default' in resolved else f"Enter {title}",
+            help_text=resolved['help_text'] if 'help_text' in resolved else f"Please enter {title.lower()}",
+            options=list(resolved.get('options', [])) if var_type == 'option' else [],
+        )
+        if len(memo) >= self.MAX_MEMO_ENTRIES:
+            memo.clear()
+        memo[var_name] = field
+        return field
+
+
+smart_field_rules = SmartFieldRules(app.config['SMART_RULES_FILE'])
+
+# Form Validation - one compiled validator per distinct form schema
+class FormValidator:
+    """Required-field and validation_pattern checks for a template's form fields.
+
+    Patterns are compiled once here rather than looked up in re's small internal
+    cache on every match, so the same validator can check any number of submissions
+    or bulk rows.
+    """
+
+    def __init__(self, form_schema):
+        self.fields = []
+        for field in form_schema:
+            patterns = []
+            for pattern, label in field['validators']:
+                try:
+                    patterns.append((re.compile(pattern), label))
+                except re.error as e:
+                    logger.error(f"Ignoring invalid validation pattern for {label}: {str(e)}")
+            self.fields.append((field['name'], field['display_name'] or field['name'],
+                                field['is_required'], patterns))
+
+    def validate(self, user_inputs):
+        """Return a list of error messages; empty if the inputs are valid."""
+        errors = []
+        for name, display_name, is_required, patterns in self.fields:
+            value = user_inputs.get(name, '')
+            if is_required and not value.strip():
+                errors.append(f"{display_name} is required")
+            # For validation pattern, apply to value if any instance has a pattern
+            if value.strip():
+                for pattern, label in patterns:
+                    if not pattern.match(value):
+                        errors.append(f"{label} is invalid")
+        return errors
+
+
+@lru_cache(maxsize=256)
+def _form_validator(form_schema):
+    """FormValidator for a JSON form schema; keyed by content, so edits never see a stale one."""
+    return FormValidator(json.loads(form_schema))
+
 # Enhanced Document Processing Functions
+class PdfConversionError(Exception):
+    """A DOCX could not be converted to PDF."""
+
 class DocumentProcessor:
     """Enhanced document processing with docxtpl."""
 
+    PLACEHOLDER_PATTERN = re.compile(r'\{\{\s*(\w+)\s*\}\}')
+    W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
+
     @staticmethod
     def extract_template_variables(template_path):
         """Extract ALL variable instances with formatting, handling multiple occurrences."""
+        return DocumentProcessor.analyze_template(template_path)[0]
+
+    @staticmethod
+    def analyze_template(template_path):
+        """Single pass over a DOCX: placeholder instances plus document-level styles.
+
+        Streams the body, headers, footers, footnotes and endnotes once each. Text boxes
+        are picked up as the nested paragraphs they are. Instances carry the part they
+        came from; paragraph_index counts paragraphs within that part. The body pass also
+        collects first-section margins, first-paragraph line spacing and the dominant
+        font and size. Returns (placeholder_instances, styles).
+        """
         placeholder_instances = []  # List to store all placeholder instances
+        styles = {'fonts': Counter(), 'sizes': Counter()}
         try:
             with ZipFile(template_path, 'r') as zip_ref:
-                # Read the main document XML
-                xml_content = zip_ref.read('word/document.xml').decode('utf-8')
-                root = ET.fromstring(xml_content)
-                namespaces = {
-                    'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
-                }
-                
-                # Process each paragraph
-                paragraphs = root.findall('.//w:p', namespaces)
-                for para_idx, para in enumerate(paragraphs):
-                    # Get paragraph-level formatting
-                    para_props = para.find('.//w:pPr', namespaces)
-                    para_alignment = None
-                    
-                    if para_props is not None:
-                        # Extract alignment
-                        jc = para_props.find('.//w:jc', namespaces)
-                        if jc is not None:
-                            para_alignment = jc.get(f'{{{namespaces["w"]}}}val')
-                    
-                    # Get all runs in the paragraph
-                    runs = para.findall('.//w:r', namespaces)
-                    runs_text = []
-                    for run in runs:
-                        run_text = ''.join(t.text or '' for t in run.findall('.//w:t', namespaces))
-                        runs_text.append(run_text)
-                    
-                    # Concatenate all run texts to form full paragraph text
-                    full_text = ''.join(runs_text)
-                    
-                    # Find all placeholder matches in the full text
-                    matches = re.finditer(r'\{\{\s*(\w+)\s*\}\}', full_text)
-                    
-                    # Compute cumulative positions for runs
-                    cum_pos = [0]
-                    for rt in runs_text:
-                        cum_pos.append(cum_pos[-1] + len(rt))
-                    
-                    for match in matches:
-                        var_name = match.group(1)
-                        
-                        # Always process - no unique skip
-                        
-                        # Find the starting run index
-                        start_pos = match.start()
-                        run_idx = None
-                        for idx in range(len(runs_text)):
-                            if cum_pos[idx] <= start_pos < cum_pos[idx + 1]:
-                                run_idx = idx
-                                break
-                        
-                        if run_idx is None:
-                            continue
-                        
-                        # Get formatting from the starting run
-                        run = runs[run_idx]
-                        run_props = run.find('.//w:rPr', namespaces)
-                        actual_formatting = {
-                            'bold': False,
-                            'italic': False,
-                            'underline': False,
-                            'font': None,
-                            'size': None
-                        }
-                        
-                        if run_props is not None:
-                            # Get ACTUAL font
-                            font = run_props.find('.//w:rFonts', namespaces)
-                            if font is not None:
-                                actual_formatting['font'] = font.get(f'{{{namespaces["w"]}}}ascii')
-                            
-                            # Get ACTUAL size
-                            size = run_props.find('.//w:sz', namespaces)
-                            if size is not None:
-                                try:
-                                    actual_formatting['size'] = int(size.get(f'{{{namespaces["w"]}}}val')) // 2  # Convert to pt
-                                except (ValueError, TypeError):
-                                    pass
-                            
-                            # Get ACTUAL styling
-                            actual_formatting['bold'] = run_props.find('.//w:b', namespaces) is not None
-                            actual_formatting['italic'] = run_props.find('.//w:i', namespaces) is not None
-                            actual_formatting['underline'] = run_props.find('.//w:u', namespaces) is not None
-                        
-                        # Store the placeholder instance with formatting
-                        placeholder_instances.append({
-                            'name': var_name,
-                            'paragraph_index': para_idx,
-                            'run_index': run_idx,
-                            'formatting': actual_formatting,
-                            'alignment': para_alignment
-                        })
-                
+                for part_name in DocumentProcessor._template_parts(zip_ref.namelist()):
+                    with zip_ref.open(part_name) as part:
+                        DocumentProcessor._extract_part_variables(
+                            part, part_name, placeholder_instances,
+                            styles if part_name == 'word/document.xml' else None)
+
                 logger.info(f"Extracted {len(placeholder_instances)} placeholder instances from {template_path}")
                 if not placeholder_instances:
                     logger.warning(f"No placeholders found in {template_path}. Ensure DOCX contains {{ var }} placeholders.")
-                    
+
         except Exception as e:
             logger.error(f"Error extracting placeholders from {template_path}: {str(e)}")
             raise
-            
-        return placeholder_instances
+
+        # Use dominant font and size for better accuracy across the entire document
+        fonts, sizes = styles.pop('fonts'), styles.pop('sizes')
+        styles['font_family'] = fonts.most_common(1)[0][0] if fonts else 'Times New Roman'
+        styles['font_size'] = round(sizes.most_common(1)[0][0]) if sizes else 13
+        return placeholder_instances, styles
 
     @staticmethod
-    def get_dominant_font_and_size(doc):
-        """Detect the most common font family and size used in the document."""
-        fonts = []
-        sizes = []
-        for para in doc.paragraphs:
-            for run in para.runs:
-                if run.text.strip():  # Only consider runs with actual text
-                    if run.font.name:
-                        fonts.append(run.font.name)
-                    if run.font.size:
-                        sizes.append(run.font.size.pt)
-        
-        dominant_font = Counter(fonts).most_common(1)[0][0] if fonts else 'Times New Roman'
-        dominant_size = round(Counter(sizes).most_common(1)[0][0]) if sizes else 13
-        
-        return dominant_font, dominant_size
+    def _template_parts(names):
+        """Parts that can hold placeholders, main document first."""
+        names = set(names)
+        by_number = lambda n: (len(n), n)  # header2.xml before header10.xml
+        parts = ['word/document.xml']
+        parts += sorted((n for n in names if re.match(r'word/header\d*\.xml$', n)), key=by_number)
+        parts += sorted((n for n in names if re.match(r'word/footer\d*\.xml$', n)), key=by_number)
+        parts += [n for n in ('word/footnotes.xml', 'word/endnotes.xml') if n in names]
+        return parts
+
+    @staticmethod
+    def _run_formatting(run_props):
+        """Formatting of a run from its w:rPr element (or None)."""
+        w = DocumentProcessor.W_NS
+        formatting = {'bold': False, 'italic': False, 'underline': False, 'font': None, 'size': None}
+        if run_props is None:
+            return formatting
+        # Get ACTUAL font
+        font = run_props.find(f'{w}rFonts')
+        if font is not None:
+            formatting['font'] = font.get(f'{w}ascii')
+        # Get ACTUAL size
+        size = run_props.find(f'{w}sz')
+        if size is not None:
+            try:
+                formatting['size'] = int(size.get(f'{w}val')) // 2  # Convert to pt
+            except (ValueError, TypeError):
+                pass
+        # Get ACTUAL styling
+        formatting['bold'] = run_props.find(f'{w}b') is not None
+        formatting['italic'] = run_props.find(f'{w}i') is not None
+        formatting['underline'] = run_props.find(f'{w}u') is not None
+        return formatting
+
+    @staticmethod
+    def _extract_part_variables(stream, part_name, placeholder_instances, styles=None):
+        """Stream one XML part, appending placeholder instances as each paragraph closes.
+
+        If styles is given (main document only), document-level styles are collected too.
+        """
+        w = DocumentProcessor.W_NS
+        tag_p, tag_r, tag_t, tag_rpr, tag_ppr, tag_jc, tag_sect, tag_spacing = (
+            f'{w}p', f'{w}r', f'{w}t', f'{w}rPr', f'{w}pPr', f'{w}jc', f'{w}sectPr', f'{w}spacing')
+        body_depth = 3  # w:document/w:body/w:p
+        elements = []    # open elements, for depth and detaching finished paragraphs
+        paragraphs = []  # open paragraphs (text boxes nest them)
+        runs = []        # open runs
+        para_count = 0
+        part_instances = []
+
+        for kind, elem in ET.iterparse(stream, events=('start', 'end')):
+            if kind == 'start':
+                elements.append(elem)
+                if elem.tag == tag_p:
+                    paragraphs.append({'index': para_count, 'depth': len(elements),
+                                       'texts': [], 'formats': [], 'alignment': None})
+                    para_count += 1
+                elif elem.tag == tag_r:
+                    runs.append({'depth': len(elements), 'text': [], 'formatting': None})
+                continue
+
+            elements.pop()
+            tag = elem.tag
+            if tag == tag_t:
+                if runs:
+                    runs[-1]['text'].append(elem.text or '')
+            elif tag == tag_rpr:
+                # Only the run's own properties, not a paragraph mark's
+                if runs and len(elements) == runs[-1]['depth']:
+                    runs[-1]['formatting'] = DocumentProcessor._run_formatting(elem)
+            elif tag == tag_ppr:
+                if paragraphs and len(elements) == paragraphs[-1]['depth']:
+                    jc = elem.find(tag_jc)
+                    if jc is not None:
+                        paragraphs[-1]['alignment'] = jc.get(f'{w}val')
+                    if styles is not None and 'default_line_spacing' not in styles \
+                            and paragraphs[-1]['depth'] == body_depth:
+                        styles['default_line_spacing'] = DocumentProcessor._line_spacing(elem.find(tag_spacing))
+            elif tag == tag_sect:
+                if styles is not None and 'margin_top' not in styles:
+                    styles.update(DocumentProcessor._section_margins(elem))
+            elif tag == tag_r:
+                run = runs.pop()
+                if paragraphs:
+                    para = paragraphs[-1]
+                    text = ''.join(run['text'])
+                    para['texts'].append(text)
+                    para['formats'].append(run['formatting'])
+                    # Dominant font/size counts runs with text directly in body paragraphs
+                    if styles is not None and para['depth'] == body_depth and run['formatting'] \
+                            and run['depth'] == body_depth + 1 and text.strip():
+                        if run['formatting']['font']:
+                            styles['fonts'][run['formatting']['font']] += 1
+                        if run['formatting']['size']:
+                            styles['sizes'][run['formatting']['size']] += 1
+            elif tag == tag_p:
+                para = paragraphs.pop()
+                if styles is not None and 'default_line_spacing' not in styles and para['depth'] == body_depth:
+                    styles['default_line_spacing'] = 1.0  # first body paragraph had no spacing
+                DocumentProcessor._paragraph_variables(para, part_name, part_instances)
+                if not paragraphs and elements:
+                    # Keep memory flat: drop finished top-level paragraphs from the tree
+                    elem.clear()
+                    elements[-1].remove(elem)
+
+        # Text box paragraphs close before the paragraph holding them; restore document order
+        part_instances.sort(key=lambda inst: inst['paragraph_index'])
+        placeholder_instances.extend(part_instances)
+
+    @staticmethod
+    def _line_spacing(spacing):
+        """Line spacing multiple from a w:spacing element; exact/at-least spacing has no multiple."""
+        w = DocumentProcessor.W_NS
+        if spacing is None or spacing.get(f'{w}line') is None:
+            return 1.0
+        if spacing.get(f'{w}lineRule', 'auto') != 'auto':
+            return None
+        try:
+            return int(spacing.get(f'{w}line')) / 240
+        except ValueError:
+            return 1.0
+
+    @staticmethod
+    def _section_margins(sect_pr):
+        """Page margins in inches from a w:sectPr element."""
+        w = DocumentProcessor.W_NS
+        margins = {}
+        pg_mar = sect_pr.find(f'{w}pgMar')
+        if pg_mar is not None:
+            for side in ('top', 'bottom', 'left', 'right'):
+                try:
+                    margins[f'margin_{side}'] = int(pg_mar.get(f'{w}{side}')) / 1440  # twips
+                except (TypeError, ValueError):
+                    pass
+        margins.setdefault('margin_top', None)  # mark the first section as seen
+        return margins
+
+    @staticmethod
+    def _paragraph_variables(para, part_name, placeholder_instances):
+        # Concatenate all run texts to form full paragraph text
+        full_text = ''.join(para['texts'])
+        if '{{' not in full_text:
+            return
+        # Cumulative start offset of each run, bisected to find the run owning a match
+        cum_pos = [0] + list(accumulate(len(t) for t in para['texts']))
+        for match in DocumentProcessor.PLACEHOLDER_PATTERN.finditer(full_text):
+            run_idx = bisect_right(cum_pos, match.start()) - 1
+            if run_idx >= len(para['texts']):
+                continue
+            # Store the placeholder instance with formatting from the starting run
+            placeholder_instances.append({
+                'name': match.group(1),
+                'part': part_name,
+                'paragraph_index': para['index'],
+                'run_index': run_idx,
+                'formatting': para['formats'][run_idx] or DocumentProcessor._run_formatting(None),
+                'alignment': para['alignment']
+            })
 
     @staticmethod
     def detect_variable_type(var_name):
         """Detect placeholder type based on name."""
-        name_lower = var_name.lower()
-        if 'date' in name_lower:
-            return 'date'
-        elif 'email' in name_lower:
-            return 'email'
-        elif 'number' in name_lower or 'amount' in name_lower or 'reg_no' in name_lower:
-            return 'number'
-        elif 'url' in name_lower:
-            return 'url'
-        elif any(x in name_lower for x in ['gender', 'relation', 'he_she', 'his_her', 'he_she', 'relationship', 'religion', 'level']):
-            return 'option'
-        return 'text'
+        return smart_field_rules.resolve(var_name).type
 
     @staticmethod
-    def validate_inputs(placeholders, user_inputs):
-        """Validate user inputs based on placeholder rules, handling instance grouping."""
-        errors = []
-        # Group placeholders by base name
-        grouped = defaultdict(list)
-        for ph in placeholders:
-            base_name = ph.name.split('_instance_')[0] if '_instance_' in ph.name else ph.name
-            grouped[base_name].append(ph)
-        
-        for base_name, phs in grouped.items():
-            value = user_inputs.get(base_name, '')
-            # Check if any of the group is required
-            if any(ph.is_required for ph in phs) and not value.strip():
-                # Use the first ph's display_name for error
-                first_ph = min(phs, key=lambda p: p.sort_order)
-                errors.append(f"{first_ph.display_name or base_name} is required")
-            # For validation pattern, apply to value if any ph has pattern
-            if value.strip():
-                for ph in phs:
-                    if ph.validation_pattern:
-                        if not re.match(ph.validation_pattern, value):
-                            errors.append(f"{ph.display_name or base_name} is invalid")
-        return errors
+    def base_name(placeholder_name):
+        """Form field name for a placeholder: 'name_instance_2' -> 'name'."""
+        return placeholder_name.split('_instance_')[0]
+
+    @staticmethod
+    def build_form_schema(placeholders):
+        """Group placeholder instances by base name into the ordered list of form fields.
+
+        Each field takes its display settings from the first instance by sort_order, is
+        required if any instance is, and carries every instance's validation pattern.
+        """
+        fields = {}
+        for ph in sorted(placeholders, key=lambda p: p.sort_order):
+            field = fields.get(ph.base_name)
+            if field is None:
+                field = fields[ph.base_name] = {
+                    'name': ph.base_name,
+                    'display_name': ph.display_name,
+                    'placeholder_type': ph.placeholder_type,
+                    'is_required': False,
+                    'options': ph.options,
+                    'help_text': ph.help_text,
+                    'default_value': ph.default_value,
+                    'sort_order': ph.sort_order,
+                    'validators': [],
+                }
+            field['is_required'] = field['is_required'] or bool(ph.is_required)
+            if ph.validation_pattern:
+                field['validators'].append([ph.validation_pattern, ph.display_name or ph.base_name])
+        return list(fields.values())
+
+    @staticmethod
+    def form_schema(template):
+        """The template's stored form fields (see build_form_schema)."""
+        if template.form_schema is None:
+            return DocumentProcessor.build_form_schema(template.placeholders)
+        return json.loads(template.form_schema)
+
+    @staticmethod
+    def form_validator(template):
+        """The template's FormValidator, shared by every request for the same form schema."""
+        form_schema = template.form_schema
+        if form_schema is None:
+            form_schema = json.dumps(DocumentProcessor.build_form_schema(template.placeholders))
+        return _form_validator(form_schema)
+
+    @staticmethod
+    def validate_inputs(template, user_inputs):
+        """Validate user inputs against a template's form fields."""
+        with timed('validate'):
+            return DocumentProcessor.form_validator(template).validate(user_inputs)
 
     @staticmethod
     def prepare_context(template, user_inputs, preserve_original_formatting=True):
         """Prepare rendering context preserving original document formatting."""
         context = {}
+        transformed = {}  # (transform, raw value) -> formatted value, shared by every instance in this render
         for ph in template.placeholders:
             # For batch processing, try base name if instance name not found
             value = user_inputs.get(ph.name, ph.default_value or '')
             
             # If not found and this looks like an instance ID, try the base name
-            if not value and '_instance_' in ph.name:
-                base_name = ph.name.split('_instance_')[0]
-                value = user_inputs.get(base_name, ph.default_value or '')
-                logger.debug(f"Using base name '{base_name}' for instance '{ph.name}': '{value}'")
+            if not value and ph.base_name != ph.name:
+                value = user_inputs.get(ph.base_name, ph.default_value or '')
+                logger.debug(f"Using base name '{ph.base_name}' for instance '{ph.name}': '{value}'")
 
-            # Apply robust data transformations
+            # Apply robust data transformations, once per distinct value
             if ph.placeholder_type == 'date':
-                original_value = value
-                value = DocumentProcessor.format_date(value, template.type)
-                logger.info(f"Date formatting for {ph.name}: '{original_value}' -> '{value}' (template: {template.type})")
+                transform = DocumentProcessor.format_date
             elif 'address' in ph.name.lower():
-                original_value = value
-                value = DocumentProcessor.format_address(value, template.type)
-                logger.info(f"Address formatting for {ph.name}: '{original_value}' -> '{value}' (template: {template.type})")
+                transform = DocumentProcessor.format_address
+            else:
+                transform = None
+            if transform is not None:
+                key = (transform, value)
+                if key not in transformed:
+                    transformed[key] = transform(value, template.type)
+                    logger.debug(f"{transform.__name__} for {ph.name}: '{value}' -> '{transformed[key]}' (template: {template.type})")
+                value = transformed[key]
             
             value = DocumentProcessor.apply_casing(value, ph.casing)
 
@@ -355,33 +1510,50 @@ class DocumentProcessor:
 
         return context
 
+    ISO_DATE_PATTERN = re.compile(r'(\d{4})-(\d{2})-(\d{2})')
+
     @staticmethod
     def format_date(date_string, template_type):
+        if not date_string or date_string.strip() == '':
+            # Auto-fill with current West Africa time
+            date_obj = datetime.now(LOCAL_TZ).date()
+        else:
+            date_obj = DocumentProcessor.parse_date(date_string)
+            if date_obj is None:
+                return date_string
+
+        day = DocumentProcessor.ordinal(date_obj.day)
+        month = date_obj.strftime("%B")
+        year = date_obj.year
+
+        if template_type.lower() == "letter":
+            return f"{day} {month}, {year}"  # 22nd September, 2025
+        elif template_type.lower() == "affidavit":
+            return f"{day} of {month}, {year}"  # 22nd of September, 2025
+        return f"{day} {month}, {year}"
+
+    @staticmethod
+    def parse_date(date_string):
+        """Calendar date of a user-entered date in West Africa time, or None if it can't be parsed.
+
+        Results are cached across requests; ISO dates (what date inputs send) skip dateutil.
+        """
+        return DocumentProcessor._parse_date(date_string, date.today())
+
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def _parse_date(date_string, today):
+        # dateutil fills missing parts ("March 2024", "5 March") from today, so today is part of the key
+        match = DocumentProcessor.ISO_DATE_PATTERN.fullmatch(date_string)
         try:
-            # Use West Africa Time
-            waz = pytz.timezone('Africa/Lagos')
-            
-            if not date_string or date_string.strip() == '':
-                # Auto-fill with current West Africa time
-                date_obj = datetime.now(waz)
-            else:
-                date_obj = parse(date_string)
-                if date_obj.tzinfo is None:
-                    date_obj = waz.localize(date_obj)
-                else:
-                    date_obj = date_obj.astimezone(waz)
-            
-            day = DocumentProcessor.ordinal(date_obj.day)
-            month = date_obj.strftime("%B")
-            year = date_obj.year
-            
-            if template_type.lower() == "letter":
-                return f"{day} {month}, {year}"  # 22nd September, 2025
-            elif template_type.lower() == "affidavit":
-                return f"{day} of {month}, {year}"  # 22nd of September, 2025
-            return f"{day} {month}, {year}"
+            if match:
+                return date(*map(int, match.groups()))
+            date_obj = parse(date_string, default=datetime.combine(today, datetime.min.time()))
         except ValueError:
-            return date_string
+            return None
+        if date_obj.tzinfo is not None:
+            date_obj = date_obj.astimezone(LOCAL_TZ)
+        return date_obj.date()
 
     @staticmethod
     def ordinal(n):
@@ -439,319 +1611,1064 @@ class DocumentProcessor:
     @staticmethod
     def get_smart_placeholder_default(var_name):
         """COMPREHENSIVE placeholder defaults for ALL variable name formats."""
-        name_lower = var_name.lower()
-        
-        # Name variations - ALL POSSIBLE FORMATS
-        if any(x in name_lower for x in ['name', 'full_name', 'student_name', 'applicant_name', 'name_1']):
-            return "Joe Doe"
-   
-            
-        # Address variations - ALL POSSIBLE FORMATS
-        elif any(x in name_lower for x in ['address', 'sender_address', 'my_address', 'location', 'residence']):
-            return "24 Avenue Avenue, Osato Junction, Benin City, Edo State"
-        elif 'street' in name_lower:
-            return "24 Avenue Avenue"
-        elif any(x in name_lower for x in ['city', 'town']):
-            return "Benin City"
-        elif 'state' in name_lower:
-            return "Edo State"
-            
-        # Department/Faculty variations
-        elif any(x in name_lower for x in ['department', 'dept']):
-            return "Production Engineering"
-        elif any(x in name_lower for x in ['faculty']):
-            return "Engineering"
-        elif any(x in name_lower for x in ['college', 'institution', 'university', 'school']):
-            return "University of Benin"
-            
-        # Academic info - ALL FORMATS
-        elif any(x in name_lower for x in ['mat_no', 'matric_no', 'reg_no', 'student_id', 'registration_number']):
-            return "ENG2204223"
-     
-            
-        # Gender variations - ALL FORMATS
-        elif 'gender' in name_lower:
-            return "Male"
-        elif any(x in name_lower for x in ['his_her', 'his_she']):
-            return "his"
-        elif any(x in name_lower for x in ['him_her', 'him_she']):
-            return "him"
-        elif any(x in name_lower for x in ['he_she', 'heshe']):
-            return "he"
-
-            
-        # Dates - NO PLACEHOLDER (auto-filled)
-        elif any(x in name_lower for x in ['date', 'time']):
-            return ""  # Will be auto-filled with current date
-            
-        # Default for unrecognized
-        return f"Enter {var_name.replace('_', ' ').title()}"
+        return smart_field_rules.resolve(var_name).default
 
     @staticmethod
     def get_smart_help_text(var_name):
         """Get intelligent help text based on variable name."""
-        name_lower = var_name.lower()
-        
-        if any(x in name_lower for x in ['name', 'full_name']):
-            return "Enter your full name (e.g., John Smith)"
-        elif 'address' in name_lower:
-            return "Enter your full address separated by commas"
-        elif 'department' in name_lower:
-            return "Enter your department name"
-        elif 'faculty' in name_lower:
-            return "Enter your faculty name"
-        elif any(x in name_lower for x in ['mat_no', 'reg_no', 'jamb_reg_no']):
-            return "Enter your matriculation/registration number"
-        elif 'date' in name_lower:
-            return "Leave blank for current date or enter custom date"
-        elif 'gender' in name_lower:
-            return "Select your gender"
-        elif 'email' in name_lower:
-            return "Enter your email address"
-            
-        return f"Please enter {var_name.replace('_', ' ').title().lower()}"
+        return smart_field_rules.resolve(var_name).help_text
 
     @staticmethod
     def get_smart_options(var_name):
         """COMPREHENSIVE option lists for ALL variable name formats."""
-        name_lower = var_name.lower()
-        
-        # Gender variations - ALL FORMATS
-        if 'gender' in name_lower:
-            return ["Male", "Female"]
-        elif  'his_her' in name_lower:
-            return ["his", "her"]
-        elif  'him_her' in name_lower:
-            return ["him", "her"]
-        elif  'he_she' in name_lower:
-            return ["he", "she"]
-            
- 
-        # Religion
-        elif 'religion' in name_lower:
-            return ["Christian", "Muslim"]
-            
-        # Relationship
-        elif any(x in name_lower for x in ['relationship', 'relation']):
-            return ["son", "daughter", "niece", "nephew", "brother", "sister"]
-            
-        return []
+        return smart_field_rules.resolve(var_name).options
+
+    @staticmethod
+    def render_document(template, user_inputs, output=None):
+        """Render a template to a path or binary stream, or to a new BytesIO if no output is given."""
+        # Use DocxTemplate for rendering - it preserves original formatting better.
+        # The compiled form is cached, so only substitution and serialization run here.
+        doc = template_cache.get(template).new_document()
+
+        # Prepare context with plain text to preserve original formatting
+        with timed('prepare_context'):
+            context = DocumentProcessor.prepare_context(template, user_inputs, preserve_original_formatting=True)
+
+        # Render the document - this preserves the original template's formatting
+        with timed('render'):
+            doc.render(context)
+
+        # Apply document-level fixes to the rendered tree, so there is no save/reopen round trip
+        with timed('post_process'):
+            DocumentProcessor.apply_margins(doc.docx, template)
+
+        if output is None:
+            output = io.BytesIO()
+        with timed('save'):
+            doc.save(output)
+        if hasattr(output, 'seek'):
+            output.seek(0)
+        return output
+
+    @staticmethod
+    def render_artifact(template, user_inputs, format, store=True):
+        """Return the rendered 'docx' or 'pdf' bytes, served from the artifact cache when possible.
+
+        With store=False a fresh render isn't written to the cache, for output nothing is kept of.
+        """
+        with timed('artifact_lookup'):
+            key = artifact_cache.key(template, user_inputs)
+            data = artifact_cache.get(key, format)
+        if data is not None:
+            logger.info(f"Artifact cache hit for template {template.id} ({format})")
+            return data
+
+        # A failed render or conversion raises here, so only real output is ever cached
+        if format == 'pdf':
+            docx_stream = io.BytesIO(DocumentProcessor.render_artifact(template, user_inputs, 'docx', store))
+            data = DocumentProcessor.convert_to_pdf(docx_stream, template=template).getvalue()
+        else:
+            data = DocumentProcessor.render_document(template, user_inputs).getvalue()
+        if store:
+            with timed('artifact_store'):
+                artifact_cache.put(key, format, data)
+        return data
+
+    @staticmethod
+    def apply_margins(document, template):
+        """Apply the template's margin overrides to the first section of a python-docx Document."""
+        # Only fix critical document-level issues, preserve paragraph/run formatting
+        try:
+            section = document.sections[0]
+            # Apply margins only if template specifies them
+            if template.margin_top:
+                section.top_margin = Inches(template.margin_top)
+            if template.margin_bottom:
+                section.bottom_margin = Inches(template.margin_bottom)
+            if template.margin_left:
+                section.left_margin = Inches(template.margin_left)
+            if template.margin_right:
+                section.right_margin = Inches(template.margin_right)
+        except Exception as e:
+            # If post-processing fails, the original rendered document is still good
+            logger.warning(f"Post-processing adjustments failed, using original render: {e}")
 
     @staticmethod
     def generate_document(template_id, user_inputs, user_name, user_email=None):
         """Generate a professional-quality document preserving original formatting."""
-        template = Template.query.get_or_404(template_id)
-        file_path = os.path.join(app.config['UPLOAD_FOLDER'], template.file_path)
+        template = snapshot_cache.get_or_404(template_id)
 
         # Validate inputs
-        errors = DocumentProcessor.validate_inputs(template.placeholders, user_inputs)
+        errors = DocumentProcessor.validate_inputs(template, user_inputs)
         if errors:
             raise ValueError("\n".join(errors))
 
         try:
-            # Use DocxTemplate for rendering - it preserves original formatting better
-            doc = DocxTemplate(file_path)
-
-            # Prepare context with plain text to preserve original formatting
-            context = DocumentProcessor.prepare_context(template, user_inputs, preserve_original_formatting=True)
-
-            # Render the document - this preserves the original template's formatting
-            doc.render(context)
-
-            # Save the document immediately to preserve formatting integrity
+            # Render (or reuse an identical earlier render) and write it once
             output_filename = f"{uuid.uuid4()}.docx"
             output_path = os.path.join(app.config['GENERATED_FOLDER'], output_filename)
-            doc.save(output_path)
-
-            # Post-process only if absolutely necessary for critical fixes
-            # Use python-docx to make minimal adjustments without breaking formatting
-            post_doc = Document(output_path)
+            docx_bytes = DocumentProcessor.render_artifact(template, user_inputs, 'docx')
+            file_size = len(docx_bytes)
+            original_filename = DocumentProcessor.build_filename(template, user_inputs)
+
+            with timed('history_write'):
+                with open(output_path, 'wb') as f:
+                    f.write(docx_bytes)
+
+                # Create database record
+                created_doc = CreatedDocument(
+                    template_id=template_id,
+                    user_name=user_name,
+                    user_email=user_email,
+                    file_path=output_filename,
+                    original_filename=original_filename,
+                    file_size=file_size,
+                    user_inputs=json.dumps(user_inputs),
+                    artifact_key=artifact_cache.key(template, user_inputs)
+                )
+                db.session.add(created_doc)
+                db.session.commit()
 
-            # Only fix critical document-level issues, preserve paragraph/run formatting
-            try:
-                # Apply margins only if template specifies them
-                if hasattr(template, 'margin_top') and template.margin_top:
-                    post_doc.sections[0].top_margin = Inches(template.margin_top)
-                if hasattr(template, 'margin_bottom') and template.margin_bottom:
-                    post_doc.sections[0].bottom_margin = Inches(template.margin_bottom)
-                if hasattr(template, 'margin_left') and template.margin_left:
-                    post_doc.sections[0].left_margin = Inches(template.margin_left)
-                if hasattr(template, 'margin_right') and template.margin_right:
-                    post_doc.sections[0].right_margin = Inches(template.margin_right)
-
-                # Save the final document
-                post_doc.save(output_path)
+            logger.info(f"Successfully generated professional document: {original_filename}")
+            return created_doc
 
-            except Exception as e:
-                logger.warning(f"Post-processing adjustments failed, using original render: {e}")
-                # If post-processing fails, the original rendered document is still good
+        except Exception as e:
+            logger.error(f"Document generation failed: {str(e)}")
+            raise
 
-            file_size = os.path.getsize(output_path)
+    @staticmethod
+    def generate_ephemeral(template_id, user_inputs, format='docx', store=True):
+        """Validate and render a document ('docx' or 'pdf') in memory, without writing to GENERATED_FOLDER.
 
-            # Generate filename
-            original_filename = f"{template.name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx"
-            if 'name' in user_inputs and user_inputs['name'].strip():
-                prefix = user_inputs['name'].replace(' ', '_').replace('/', '_').replace('\\', '_')
-                original_filename = f"{prefix}_{original_filename}"
+        store=False also keeps the render out of the artifact cache. Returns (template, stream,
+        original_filename); original_filename is the .docx name.
+        """
+        template = snapshot_cache.get_or_404(template_id)
 
-            # Create database record
-            created_doc = CreatedDocument(
-                template_id=template_id,
-                user_name=user_name,
-                user_email=user_email,
-                file_path=output_filename,
-                original_filename=original_filename,
-                file_size=file_size,
-                user_inputs=json.dumps(user_inputs)
-            )
-            db.session.add(created_doc)
-            db.session.commit()
-
-            logger.info(f"Successfully generated professional document: {original_filename}")
-            return created_doc
+        errors = DocumentProcessor.validate_inputs(template, user_inputs)
+        if errors:
+            raise ValueError("\n".join(errors))
 
+        try:
+            stream = io.BytesIO(DocumentProcessor.render_artifact(template, user_inputs, format, store))
+            return template, stream, DocumentProcessor.build_filename(template, user_inputs)
         except Exception as e:
             logger.error(f"Document generation failed: {str(e)}")
             raise
 
     @staticmethod
-    def convert_to_pdf(docx_path):
-        """Convert DOCX to PDF using image-based approach for perfect formatting."""
+    def build_filename(template, user_inputs):
+        """Build the user-facing download name: name_documentname_timestamp.docx"""
+        original_filename = f"{template.name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.docx"
+        if 'name' in user_inputs and user_inputs['name'].strip():
+            prefix = user_inputs['name'].replace(' ', '_').replace('/', '_').replace('\\', '_')
+            original_filename = f"{prefix}_{original_filename}"
+        return original_filename
+
+    @staticmethod
+    def convert_to_pdf(docx_source, pdf_output=None, template=None):
+        """Convert DOCX to a vector PDF, laying out paragraphs, runs and tables with ReportLab.
+
+        docx_source may be a path or a binary stream. The PDF is written to pdf_output
+        (a path or stream); by default next to a path source, or into a new BytesIO
+        for a stream source. template, if given, supplies the default font. Returns pdf_output.
+        Raises PdfConversionError if the document can't be laid out.
+        """
+        if pdf_output is None:
+            pdf_output = io.BytesIO() if hasattr(docx_source, 'read') else docx_source.replace('.docx', '.pdf')
         try:
-            # Create a temporary directory for images
-            with tempfile.TemporaryDirectory() as temp_dir:
-                # Convert DOCX to images (simulate with a high-quality render)
-                # For now, we'll create a simple image representation
-                # In production, you might want to use a more sophisticated approach
-                
-                # Read the DOCX content
-                doc = Document(docx_path)
-                
-                # Create a high-quality image representation
-                images = []
-                
-                # For each "page" (simplified - in reality, you'd need proper pagination)
-                # This is a simplified approach that creates one image per section
-                for i, section in enumerate(doc.sections):
-                    # Create an image with the content
-                    img_width = int(section.page_width.pt)
-                    img_height = int(section.page_height.pt)
-                    
-                    # Create a high-resolution image (300 DPI for print quality)
-                    dpi = 300
-                    img_width_px = int(img_width * dpi / 72)
-                    img_height_px = int(img_height * dpi / 72)
-                    
-                    image = Image.new('RGB', (img_width_px, img_height_px), 'white')
-                    draw = ImageDraw.Draw(image)
-                    
-                    # Simple text rendering (in production, use proper layout engine)
-                    y_position = 100  # Start position
-                    
-                    for paragraph in doc.paragraphs:
-                        if paragraph.text.strip():
-                            # Use a basic font
-                            try:
-                                font = ImageFont.truetype("arial.ttf", 40)
-                            except:
-                                font = ImageFont.load_default()
-                            
-                            # Draw the paragraph text
-                            draw.text((100, y_position), paragraph.text, fill='black', font=font)
-                            y_position += 60
-                    
-                    # Save the image
-                    img_path = os.path.join(temp_dir, f"page_{i+1}.png")
-                    image.save(img_path, 'PNG', dpi=(dpi, dpi))
-                    images.append(img_path)
-                
-                # Convert images to PDF
-                pdf_path = docx_path.replace('.docx', '.pdf')
-                
-                with open(pdf_path, "wb") as f:
-                    if images:
-                        f.write(img2pdf.convert(images))
+            with timed('pdf_parse'):
+                doc = Document(docx_source)
+            section = doc.sections[0]
+
+            # Document defaults: Normal style, then the template, then Times 12
+            normal_font = doc.styles['Normal'].font
+            defaults = {
+                'font': normal_font.name or (template.font_family if template else None) or 'Times New Roman',
+                'size': normal_font.size.pt if normal_font.size else (template.font_size if template and template.font_size else 12),
+                'line_spacing': (template.default_line_spacing if template and template.default_line_spacing else 1.0),
+                'styles': {},
+            }
+
+            pdf = SimpleDocTemplate(
+                pdf_output,
+                pagesize=(section.page_width.pt, section.page_height.pt),
+                topMargin=section.top_margin.pt,
+                bottomMargin=section.bottom_margin.pt,
+                leftMargin=section.left_margin.pt,
+                rightMargin=section.right_margin.pt,
+                title=doc.core_properties.title or '',
+                author=doc.core_properties.author or '',
+            )
+
+            story = []
+            with timed('pdf_layout'):
+                for block in doc.iter_inner_content():
+                    if isinstance(block, DocxParagraph):
+                        story.extend(DocumentProcessor._pdf_paragraph(block, defaults))
                     else:
-                        # Fallback: create a simple PDF if no images
-                        c = canvas.Canvas(pdf_path, pagesize=letter)
-                        c.drawString(100, 750, "Document converted to PDF")
-                        c.save()
-                
-                logger.info(f"Successfully converted DOCX to PDF using image-based method: {pdf_path}")
-                return pdf_path
-                
+                        story.append(DocumentProcessor._pdf_table(block, defaults, pdf.width, pdf.height))
+                if not story:
+                    story.append(Spacer(1, 1))
+
+            with timed('pdf_build'):
+                pdf.build(story)
+            logger.info(f"Successfully converted DOCX to PDF: {pdf_output}")
+
         except Exception as e:
-            logger.error(f"Image-based PDF conversion failed: {str(e)}")
-            # Fallback to simple PDF creation
-            return DocumentProcessor._create_simple_pdf(docx_path)
+            logger.error(f"PDF conversion failed: {str(e)}")
+            # Don't leave a half-written PDF where callers look for a finished one
+            if not hasattr(pdf_output, 'write') and os.path.exists(pdf_output):
+                os.remove(pdf_output)
+            raise PdfConversionError(str(e)) from e
+
+        if hasattr(pdf_output, 'seek'):
+            pdf_output.seek(0)
+        return pdf_output
+
+    _PDF_ALIGNMENTS = {
+        WD_ALIGN_PARAGRAPH.LEFT: TA_LEFT,
+        WD_ALIGN_PARAGRAPH.CENTER: TA_CENTER,
+        WD_ALIGN_PARAGRAPH.RIGHT: TA_RIGHT,
+        WD_ALIGN_PARAGRAPH.JUSTIFY: TA_JUSTIFY,
+        WD_ALIGN_PARAGRAPH.DISTRIBUTE: TA_JUSTIFY,
+    }
 
     @staticmethod
-    def _create_simple_pdf(docx_path):
-        """Create a simple PDF as fallback."""
-        pdf_path = docx_path.replace('.docx', '.pdf')
+    def _pdf_paragraph(paragraph, defaults):
+        """Turn a python-docx paragraph into flowables, splitting at page breaks."""
+        fmt = paragraph.paragraph_format
+        # Style lookup scans every style in the document, so resolve each style id once per conversion
+        style_id = paragraph._p.style
+        if style_id not in defaults['styles']:
+            style = paragraph.style
+            defaults['styles'][style_id] = (style.paragraph_format, style.font) if style is not None else (None, None)
+        style_fmt, style_font = defaults['styles'][style_id]
+
+        def pick(attr):
+            value = getattr(fmt, attr)
+            if value is None and style_fmt is not None:
+                value = getattr(style_fmt, attr)
+            return value
+
+        alignment = DocumentProcessor._PDF_ALIGNMENTS.get(pick('alignment'), TA_LEFT)
+        family = (style_font.name if style_font is not None else None) or defaults['font']
+        base_size = style_font.size.pt if style_font is not None and style_font.size else defaults['size']
+
+        flowables = []
+        if pick('page_break_before'):
+            flowables.append(PageBreak())
+
+        chunks = [[]]  # markup per page-break-separated chunk
+        max_size = base_size
+        br_tag, type_attr = f'{DocumentProcessor.W_NS}br', f'{DocumentProcessor.W_NS}type'
+        # paragraph.runs only sees direct w:r children; runs inside hyperlinks, content controls and
+        # tracked insertions are nested deeper. Runs of a text box's own paragraphs are left out.
+        runs = [DocxRun(r, paragraph) for r in paragraph._p.iter(f'{DocumentProcessor.W_NS}r')
+                if next(r.iterancestors(f'{DocumentProcessor.W_NS}p')) is paragraph._p]
+        for run in runs:
+            # The run's text in document order, cut at page breaks (what run.text joins, minus those)
+            segments = [[]]
+            for child in run._r.xpath('w:br | w:cr | w:noBreakHyphen | w:ptab | w:t | w:tab'):
+                if child.tag == br_tag and child.get(type_attr) == 'page':
+                    segments.append([])
+                else:
+                    segments[-1].append(str(child))
+            if not any(segments):
+                chunks.extend([] for _ in segments[1:])
+                continue
+            size = run.font.size.pt if run.font.size else base_size
+            max_size = max(max_size, size)
+            bold = run.bold if run.bold is not None else bool(style_font is not None and style_font.bold)
+            italic = run.italic if run.italic is not None else bool(style_font is not None and style_font.italic)
+            font_name = font_registry.pdf_font(run.font.name or family, bold, italic)
+            for i, segment in enumerate(segments):
+                if i:
+                    chunks.append([])
+                text = ''.join(segment)
+                if not text:
+                    continue
+                markup = xml_escape(text).replace('\n', '<br/>').replace('\t', '&nbsp;' * 4)
+                markup = f'<font name="{font_name}" size="{size:g}">{markup}</font>'
+                if run.underline:
+                    markup = f'<u>{markup}</u>'
+                chunks[-1].append(markup)
+
+        # Leading from line spacing: a float is a multiple, a Length is an exact height
+        line_spacing = pick('line_spacing') or defaults['line_spacing']
+        if hasattr(line_spacing, 'pt'):
+            leading = line_spacing.pt
+        else:
+            leading = max_size * 1.2 * float(line_spacing)
+
+        left_indent = pick('left_indent')
+        right_indent = pick('right_indent')
+        first_line_indent = pick('first_line_indent')
+        space_before = pick('space_before')
+        space_after = pick('space_after')
+        style = ParagraphStyle(
+            'docx',
+            fontName=font_registry.pdf_font(family),
+            fontSize=base_size,
+            leading=leading,
+            alignment=alignment,
+            leftIndent=left_indent.pt if left_indent else 0,
+            rightIndent=right_indent.pt if right_indent else 0,
+            firstLineIndent=first_line_indent.pt if first_line_indent else 0,
+            spaceBefore=space_before.pt if space_before else 0,
+            spaceAfter=space_after.pt if space_after else 0,
+        )
+
+        for i, chunk in enumerate(chunks):
+            if i:
+                flowables.append(PageBreak())
+            markup = ''.join(chunk)
+            if markup.strip():
+                flowables.append(Paragraph(markup, style))
+            elif i == len(chunks) - 1 or not chunks[i + 1]:
+                # Empty paragraphs still take up a line
+                flowables.append(Spacer(1, leading + style.spaceBefore + style.spaceAfter))
+        return flowables
+
+    @staticmethod
+    def _pdf_table(table, defaults, available_width, available_height):
+        """Turn a python-docx table into a ReportLab table with the cells' paragraphs."""
+        rows = []
+        for row in table.rows:
+            cells = []
+            for cell in row.cells:
+                content = []
+                for paragraph in cell.paragraphs:
+                    content.extend(f for f in DocumentProcessor._pdf_paragraph(paragraph, defaults)
+                                   if not isinstance(f, PageBreak))
+                cells.append(content)
+            rows.append(cells)
+        columns = max((len(r) for r in rows), default=1) or 1
+        rows = [r + [[]] * (columns - len(r)) for r in rows]
+        column_width = available_width / columns
+        # A row taller than a page (e.g. a one-cell layout table holding a whole letter) can't be
+        # placed, and ReportLab's own in-row split only succeeds when a flowable ends exactly at the
+        # page foot, so such rows are cut into page-sized rows first. The frame and cell paddings
+        # (6pt and 3pt a side) come off the page height.
+        row_height = available_height - 12 - 6 - 1
+        rows = [piece for row in rows
+                for piece in DocumentProcessor._pdf_split_row(row, column_width - 12, row_height)]
+        pdf_table = PdfTable(rows or [['']], colWidths=[column_width] * columns, splitInRow=1)
+        commands = [('VALIGN', (0, 0), (-1, -1), 'TOP')]
+        if DocumentProcessor._pdf_table_has_borders(table):
+            commands.append(('GRID', (0, 0), (-1, -1), 0.5, (0, 0, 0)))
+        pdf_table.setStyle(TableStyle(commands))
+        return pdf_table
+
+    @staticmethod
+    def _pdf_table_has_borders(table):
+        """Whether the table, or a style it inherits from, draws any w:tblBorders edge (layout tables don't)."""
+        elements = [table._tbl]
+        style = table.style
+        while style is not None:
+            elements.append(style.element)
+            style = style.base_style
+        for element in elements:
+            borders = element.xpath('./w:tblPr/w:tblBorders')
+            if borders:
+                return any(edge.get(f'{DocumentProcessor.W_NS}val') not in ('nil', 'none')
+                           for edge in borders[0])
+        return False
+
+    @staticmethod
+    def _pdf_split_row(cells, width, max_height):
+        """Split a row of flowable lists into rows no taller than max_height, splitting paragraphs by line."""
+        pieces = []  # per cell, its content for each output row
+        for content in cells:
+            parts, used, queue = [[]], 0, list(content)
+            while queue:
+                flowable = queue.pop(0)
+                height = flowable.wrap(width, max_height)[1] + flowable.getSpaceBefore() + flowable.getSpaceAfter()
+                if used + height <= max_height:
+                    parts[-1].append(flowable)
+                    used += height
+                    continue
+                split = flowable.split(width, max_height - used) if max_height > used else []
+                if split:
+                    parts[-1].append(split[0])
+                    queue[:0] = split[1:]
+                elif not parts[-1]:
+                    # Can't be split and fills a page on its own; leave it for ReportLab
+                    parts[-1].append(flowable)
+                    used += height
+                    continue
+                else:
+                    queue.insert(0, flowable)
+                parts.append([])
+                used = 0
+            pieces.append(parts)
+        count = max(len(parts) for parts in pieces)
+        return [[parts[i] if i < len(parts) else [] for parts in pieces] for i in range(count)]
+
+def persist_generated_document(template_id, docx_bytes, user_inputs, user_name, user_email, original_filename,
+                               artifact_key=None):
+    """Write an ephemerally generated document to disk and record it in history (runs in background)."""
+    with app.app_context(), timed('history_write'):
         try:
-            c = canvas.Canvas(pdf_path, pagesize=letter)
-            c.drawString(100, 750, "PDF Conversion")
-            c.drawString(100, 730, "Document converted successfully")
-            c.save()
-            return pdf_path
+            output_filename = f"{uuid.uuid4()}.docx"
+            output_path = os.path.join(app.config['GENERATED_FOLDER'], output_filename)
+            with open(output_path, 'wb') as f:
+                f.write(docx_bytes)
+            db.session.add(CreatedDocument(
+                template_id=template_id,
+                user_name=user_name,
+                user_email=user_email,
+                file_path=output_filename,
+                original_filename=original_filename,
+                file_size=len(docx_bytes),
+                user_inputs=json.dumps(user_inputs),
+                artifact_key=artifact_key
+            ))
+            db.session.commit()
+            logger.info(f"Persisted generated document to history: {original_filename}")
         except Exception as e:
-            logger.error(f"Simple PDF creation also failed: {str(e)}")
-            raise
+            db.session.rollback()
+            logger.error(f"Failed to persist generated document {original_filename}: {str(e)}")
+
+# Generated-file lifecycle - one reaper thread per process deletes files off the request path and
+# periodically sweeps GENERATED_FOLDER for orphans, expired documents and quota overruns
+class StorageReaper:
+    """Deletes generated files in the background and keeps GENERATED_FOLDER within its retention and quota.
+
+    A document's files are <uuid>.docx and an optional <uuid>.pdf. Recency is the newest file
+    mtime, which downloads refresh, so quota eviction removes the least recently used first.
+    """
+
+    DELETE_CHUNK = 500  # ids per DELETE statement, well under SQLite's bound-parameter limit
+
+    def __init__(self):
+        self._pending = deque()
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def ensure_started(self):
+        """Start this process's reaper thread (again after a fork, which doesn't carry threads over)."""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='storage-reaper', daemon=True)
+                self._thread.start()
+
+    def discard(self, file_path):
+        """Queue a document's .docx and .pdf for deletion."""
+        self.ensure_started()
+        stem = os.path.splitext(os.path.join(app.config['GENERATED_FOLDER'], file_path))[0]
+        self._pending.extend((stem + '.docx', stem + '.pdf'))
+        self._wake.set()
 
-# FIXED Batch Processing - No threading, proper context management
-def process_batch(template_ids, user_inputs, user_name, user_email=None):
-    """Fixed batch processing that actually works - generates documents sequentially."""
-    batch_id = str(uuid.uuid4())
+    @staticmethod
+    def touch(path):
+        """Mark a generated file as recently used."""
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _run(self):
+        interval = app.config['STORAGE_SWEEP_INTERVAL']
+        next_sweep = time.monotonic() + min(interval, 60)  # first sweep shortly after startup
+        while True:
+            self._wake.wait(max(0.0, next_sweep - time.monotonic()) if interval else None)
+            self._wake.clear()
+            self._unlink_pending()
+            if interval and time.monotonic() >= next_sweep:
+                try:
+                    with app.app_context():
+                        self.sweep()
+                except Exception as e:
+                    logger.error(f"Storage sweep failed: {str(e)}")
+                next_sweep = time.monotonic() + interval
+
+    def _unlink_pending(self):
+        while self._pending:
+            path = self._pending.popleft()
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Could not delete {path}: {e}")
+
+    @contextmanager
+    def _sweep_lock(self):
+        """Hold a non-blocking lock file so only one worker process sweeps at a time; yields False if busy."""
+        if fcntl is None:
+            yield True
+            return
+        with open(os.path.join(app.config['TEMP_FOLDER'], 'storage_reaper.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def sweep(self):
+        """One reconciliation pass (needs an app context). Returns counts, or None if another process is sweeping."""
+        with self._sweep_lock() as acquired:
+            if not acquired:
+                return None
+            return self._sweep()
+
+    def _sweep(self):
+        folder = app.config['GENERATED_FOLDER']
+        now = time.time()
+
+        # One directory scan: stem -> [paths, total bytes, newest mtime]
+        files = {}
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+                group = files.setdefault(os.path.splitext(entry.name)[0], [[], 0, 0.0])
+                group[0].append(entry.path)
+                group[1] += stat.st_size
+                group[2] = max(group[2], stat.st_mtime)
+
+        # Which stems still have a history row, streamed rather than loaded as objects
+        documents = {}
+        artifact_keys = {}
+        for doc_id, file_path, artifact_key in db.session.execute(
+                db.select(CreatedDocument.id, CreatedDocument.file_path, CreatedDocument.artifact_key)
+                .execution_options(yield_per=1000)):
+            documents[os.path.splitext(file_path)[0]] = doc_id
+            if artifact_key:
+                artifact_keys[doc_id] = artifact_key
+
+        # Files with no row, old enough that their row isn't simply still being written
+        grace = app.config['STORAGE_ORPHAN_GRACE']
+        orphans = [stem for stem, (_, _, mtime) in files.items()
+                   if stem not in documents and now - mtime > grace]
+
+        expired_ids = []
+        retention_days = app.config['GENERATED_RETENTION_DAYS']
+        if retention_days:
+            cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=retention_days)
+            expired_ids = db.session.execute(
+                db.select(CreatedDocument.id).where(CreatedDocument.created_at < cutoff)).scalars().all()
+        expired = set(expired_ids)
+
+        # Least recently used documents go until usage is back under 90% of the quota,
+        # so a folder hovering at the limit isn't trimmed on every pass
+        evicted = []
+        quota = app.config['GENERATED_QUOTA_MB'] * 1024 * 1024
+        if quota:
+            kept = [(mtime, size, stem) for stem, (_, size, mtime) in files.items()
+                    if stem in documents and documents[stem] not in expired]
+            usage = sum(size for _, size, _ in kept)
+            if usage > quota:
+                for mtime, size, stem in sorted(kept):
+                    if usage <= quota * 0.9:
+                        break
+                    evicted.append(documents[stem])
+                    usage -= size
+
+        # Rows first, in one transaction, then files: a failed unlink leaves an orphan the next pass removes
+        doomed_ids = expired_ids + evicted
+        for start in range(0, len(doomed_ids), self.DELETE_CHUNK):
+            chunk = doomed_ids[start:start + self.DELETE_CHUNK]
+            db.session.execute(db.delete(CreatedDocument).where(CreatedDocument.id.in_(chunk)))
+        db.session.commit()
+        if doomed_ids:
+            cache_tags.invalidate('documents')
+
+        doomed_ids = set(doomed_ids)
+        for doc_id in doomed_ids & artifact_keys.keys():
+            artifact_cache.discard(artifact_keys[doc_id])
+        doomed_stems = orphans + [stem for stem, doc_id in documents.items() if doc_id in doomed_ids]
+        freed = 0
+        for stem in doomed_stems:
+            paths, size, _ = files.get(stem, ([], 0, 0))
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            freed += size
+
+        result = {'orphans': len(orphans), 'expired': len(expired_ids), 'evicted': len(evicted),
+                  'bytes_freed': freed}
+        if doomed_stems:
+            logger.info(f"Storage sweep removed {result['orphans']} orphaned, {result['expired']} expired and "
+                        f"{result['evicted']} evicted documents ({freed / (1024 * 1024):.1f} MB)")
+        return result
+
+storage_reaper = StorageReaper()
+
+# Parallel Batch Processing - renders fan out to a worker pool, DB work stays in the caller
+_batch_executor = None
+_batch_executor_lock = threading.Lock()
+
+def get_batch_executor(broken=None):
+    """Return the process-wide batch pool, created on first use from BATCH_EXECUTOR/BATCH_WORKERS.
+
+    A pool that has broken (a worker died, e.g. OOM-killed) fails every later submit, so it is
+    replaced; pass the pool a submit failed on as broken to force that.
+    """
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is not None and (_batch_executor is broken or getattr(_batch_executor, '_broken', False)):
+            logger.warning("Batch pool is broken, starting a new one")
+            _batch_executor.shutdown(wait=False, cancel_futures=True)
+            _batch_executor = None
+        if _batch_executor is None:
+            workers = app.config['BATCH_WORKERS']
+            if app.config['BATCH_EXECUTOR'] == 'process':
+                # Forked workers would inherit the parent's threads, locks and database connections
+                method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+                _batch_executor = ProcessPoolExecutor(max_workers=workers,
+                                                      mp_context=multiprocessing.get_context(method))
+            else:
+                _batch_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch')
+            logger.info(f"Started {app.config['BATCH_EXECUTOR']} batch pool with {workers} workers")
+        return _batch_executor
+
+def submit_batch_task(fn, *args):
+    """Submit fn(*args) to the batch pool, replacing the pool once if it turns out to be broken."""
+    executor = get_batch_executor()
+    try:
+        return executor.submit(fn, *args)
+    except BrokenExecutor:
+        return get_batch_executor(broken=executor).submit(fn, *args)
+
+def render_batch_document(snapshot, user_inputs):
+    """Worker: render one batch document to GENERATED_FOLDER. Never touches the database.
+
+    Returns ((output_filename, file_size, original_filename), stage timings).
+    """
+    with app.app_context(), collect_stage_timings() as timings:
+        output_filename = f"{uuid.uuid4()}.docx"
+        output_path = os.path.join(app.config['GENERATED_FOLDER'], output_filename)
+        DocumentProcessor.render_document(snapshot, user_inputs, output_path)
+        result = output_filename, os.path.getsize(output_path), DocumentProcessor.build_filename(snapshot, user_inputs)
+    return result, timings
+
+def create_batch(template_ids, user_inputs, user_name, user_email=None):
+    """Record a new pending batch."""
     batch = BatchGeneration(
-        batch_id=batch_id,
+        batch_id=str(uuid.uuid4()),
         user_name=user_name,
         user_email=user_email,
         template_ids=json.dumps(template_ids),
         user_inputs=json.dumps(user_inputs),
         total_documents=len(template_ids),
-        status='processing'
+        status='pending'
     )
     db.session.add(batch)
     db.session.commit()
+    return batch
+
+def run_batch(batch_id):
+    """Generate one document per template of a pending batch in parallel.
+
+    Progress is written to the batch row as renders finish; the documents and final
+    status are recorded together in one transaction at the end.
+    """
+    started = time.perf_counter()
+    # Claim the batch atomically, so one that was queued twice (e.g. requeued after a restart) runs once
+    claimed = db.session.execute(
+        db.update(BatchGeneration)
+        .where(BatchGeneration.batch_id == batch_id, BatchGeneration.status == 'pending')
+        .values(status='processing', updated_at=datetime.now(timezone.utc))
+    ).rowcount
+    db.session.commit()
+    batch = BatchGeneration.query.filter_by(batch_id=batch_id).one()
+    if not claimed:
+        logger.info(f"Batch {batch_id} is already {batch.status}, skipping")
+        return batch, []
+    template_ids = json.loads(batch.template_ids)
+    user_inputs = json.loads(batch.user_inputs)
 
-    successful = []
     errors = []
-
-    # Process each template sequentially to avoid context issues
-    for template_id in template_ids:
+    futures = {}
+
+    # Load and validate every template up front (one IN query on a cache miss), then hand workers the snapshots
+    # The batch form posts ids as strings
+    templates = {str(template_id): snapshot for template_id, snapshot in snapshot_cache.get_many(template_ids).items()}
+    for position, template_id in enumerate(template_ids):
+        template = templates.get(str(template_id))
+        if template is None:
+            errors.append(f"Template {template_id}: template not found")
+            continue
+        validation_errors = DocumentProcessor.validate_inputs(template, user_inputs)
+        if validation_errors:
+            errors.append(f"Template {template_id}: " + "\n".join(validation_errors))
+            continue
+        logger.info(f"Processing template {template_id} for batch {batch_id}")
+        future = submit_batch_task(render_batch_document, template, user_inputs)
+        futures[future] = (position, template.id)
+
+    rendered = []
+    last_progress = time.monotonic()
+    for future in as_completed(futures):
+        position, template_id = futures[future]
         try:
-            logger.info(f"Processing template {template_id} for batch {batch_id}")
-            
-            # Generate document using existing working method
-            doc = DocumentProcessor.generate_document(template_id, user_inputs, user_name, user_email)
-            doc.batch_id = batch_id
-            db.session.add(doc)
-            db.session.commit()
-            
-            successful.append(doc)
-            logger.info(f"Successfully generated document {doc.id} for template {template_id}")
-            
+            (output_filename, file_size, original_filename), timings = future.result()
+            observe_stage_timings(timings)
+            rendered.append((position, CreatedDocument(
+                template_id=template_id,
+                user_name=batch.user_name,
+                user_email=batch.user_email,
+                file_path=output_filename,
+                original_filename=original_filename,
+                file_size=file_size,
+                batch_id=batch_id,
+                user_inputs=batch.user_inputs
+            )))
         except Exception as e:
-            error_msg = f"Template {template_id}: {str(e)}"
-            errors.append(error_msg)
+            errors.append(f"Template {template_id}: {str(e)}")
             logger.error(f"Error generating document for template {template_id}: {str(e)}")
 
-    # Update batch status
-    batch.successful_documents = len(successful)
-    batch.status = 'completed' if not errors else 'completed_with_errors'
-    batch.error_message = "\n".join(errors) if errors else None
-    batch.completed_at = datetime.now(timezone.utc)
-    db.session.commit()
+        # Throttled progress update for pollers
+        if time.monotonic() - last_progress >= app.config['BATCH_PROGRESS_INTERVAL']:
+            batch.successful_documents = len(rendered)
+            batch.updated_at = datetime.now(timezone.utc)
+            db.session.commit()
+            last_progress = time.monotonic()
+
+    # Record documents (in template order) and batch status together
+    with timed('batch_commit'):
+        successful = [doc for _, doc in sorted(rendered, key=lambda item: item[0])]
+        db.session.add_all(successful)
+        batch.successful_documents = len(successful)
+        batch.status = 'completed' if not errors else 'completed_with_errors'
+        batch.error_message = "\n".join(errors) if errors else None
+        batch.completed_at = datetime.now(timezone.utc)
+        db.session.commit()
+    stage_metrics.observe('batch_total', time.perf_counter() - started)
 
-    logger.info(f"Batch {batch_id} completed: {len(successful)} successful, {len(errors)} errors")
+    logger.info(f"Batch {batch_id} completed in {time.perf_counter() - started:.2f}s: "
+                f"{len(successful)} successful, {len(errors)} errors")
     return batch, successful
 
+def process_batch(template_ids, user_inputs, user_name, user_email=None):
+    """Create and run a batch synchronously."""
+    batch = create_batch(template_ids, user_inputs, user_name, user_email)
+    return run_batch(batch.batch_id)
+
+# Batch job queue - POST /batch returns immediately, a local pool runs the batch
+batch_job_executor = ThreadPoolExecutor(max_workers=app.config['BATCH_JOB_WORKERS'],
+                                        thread_name_prefix='batch-job')
+
+def enqueue_batch(template_ids, user_inputs, user_name, user_email=None, profile_id=None, profile_trigger=None):
+    """Create a pending batch and queue it for background processing, profiled as profile_id if given."""
+    batch = create_batch(template_ids, user_inputs, user_name, user_email)
+    batch_job_executor.submit(run_batch_job, batch.batch_id, profile_id, profile_trigger)
+    return batch
+
+def run_batch_job(batch_id, profile_id=None, profile_trigger=None):
+    """Queue worker: run a batch in its own app context, marking it failed if it crashes."""
+    with app.app_context():
+        try:
+            if profile_id:
+                # Renders in a process pool run outside this profile; only their waits show up
+                with request_profiler.capture(profile_id, endpoint='batch (job)', method='JOB', status=None,
+                                              trigger=profile_trigger, path=f'batch {batch_id}', stages={}):
+                    run_batch(batch_id)
+            else:
+                run_batch(batch_id)
+        except Exception as e:
+            logger.error(f"Batch job {batch_id} failed: {str(e)}")
+            db.session.rollback()
+            batch = BatchGeneration.query.filter_by(batch_id=batch_id).first()
+            if batch is not None:
+                batch.status = 'failed'
+                batch.error_message = str(e)
+                batch.completed_at = datetime.now(timezone.utc)
+                db.session.commit()
+
+def recover_batch(batch):
+    """Requeue a pending batch, or fail a processing one whose job has gone quiet for BATCH_STALE_SECONDS.
+
+    Queued jobs live only in this process, so a restart or crashed worker leaves their batches
+    behind. Pending batches are simply queued again (run_batch's claim makes a duplicate harmless);
+    a batch that was mid-run is failed rather than rerun, so one that crashes its worker can't loop.
+    Returns True if the batch was requeued or failed.
+    """
+    if batch.status == 'pending':
+        batch_job_executor.submit(run_batch_job, batch.batch_id)
+        return True
+    cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(seconds=app.config['BATCH_STALE_SECONDS'])
+    last_seen = batch.updated_at or batch.created_at
+    if batch.status == 'processing' and last_seen.replace(tzinfo=None) < cutoff:
+        logger.warning(f"Batch {batch.batch_id} stopped making progress, marking it failed")
+        batch.status = 'failed'
+        batch.error_message = 'Generation was interrupted (the server restarted or a worker stopped). ' \
+                              'Please submit the batch again.'
+        batch.completed_at = datetime.now(timezone.utc)
+        db.session.commit()
+        return True
+    return False
+
+def recover_batches():
+    """At startup, requeue or fail the batches an earlier process left unfinished."""
+    recovered = sum(recover_batch(batch) for batch in
+                    BatchGeneration.query.filter(BatchGeneration.status.in_(['pending', 'processing'])))
+    if recovered:
+        logger.info(f"Recovered {recovered} unfinished batches")
+
+# Streaming ZIP - archives are emitted entry by entry instead of being built in memory
+class _ZipStreamSink:
+    """Write-only, non-seekable sink; zipfile falls back to data descriptors and we drain it per entry."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def stream_zip(entries, compression=ZIP_STORED, compresslevel=None, chunk_size=64 * 1024):
+    """Yield a ZIP archive chunk by chunk from (arcname, source) pairs.
+
+    source is either bytes/str or a binary file object, which is copied in chunks so
+    memory stays flat regardless of file size.
+    """
+    sink = _ZipStreamSink()
+    with ZipFile(sink, 'w', compression=compression, compresslevel=compresslevel) as zip_file:
+        for arcname, source in entries:
+            if hasattr(source, 'read'):
+                with zip_file.open(arcname, 'w') as dest:
+                    for chunk in iter(lambda: source.read(chunk_size), b''):
+                        dest.write(chunk)
+                        data = sink.drain()
+                        if data:
+                            yield data
+            else:
+                zip_file.writestr(arcname, source)
+            data = sink.drain()
+            if data:
+                yield data
+    yield sink.drain()
+
+def zip_compression(level):
+    """Map a 0-9 compression level to zipfile arguments; 0 means stored."""
+    level = max(0, min(9, level))
+    if level == 0:
+        return {'compression': ZIP_STORED}
+    return {'compression': ZIP_DEFLATED, 'compresslevel': level}
+
+def convert_batch_pdf(docx_path):
+    """Worker: convert a generated DOCX to a PDF next to it. Returns the stage timings."""
+    with app.app_context(), collect_stage_timings() as timings:
+        DocumentProcessor.convert_to_pdf(docx_path)
+    return timings
+
+def batch_zip_entries(documents, include_pdfs=False):
+    """Yield ZIP entries for (docx_path, original_filename) pairs, read straight from disk.
+
+    With include_pdfs, missing PDFs are converted on the batch pool a bounded number
+    of documents ahead of the writer.
+    """
+    window = max(1, app.config['BATCH_WORKERS'] * 2)
+    pending = deque()
+
+    def entries_for(docx_path, original_filename, pdf_future):
+        with open(docx_path, 'rb') as f:
+            yield original_filename, f
+        pdf_path = docx_path.replace('.docx', '.pdf')
+        if pdf_future is not None:
+            try:
+                observe_stage_timings(pdf_future.result())
+            except Exception as e:
+                logger.error(f"PDF conversion for {original_filename} failed: {str(e)}")
+        if os.path.exists(pdf_path):
+            with open(pdf_path, 'rb') as f:
+                yield original_filename.replace('.docx', '.pdf'), f
+
+    for docx_path, original_filename in documents:
+        pdf_future = None
+        if include_pdfs and not os.path.exists(docx_path.replace('.docx', '.pdf')):
+            pdf_future = submit_batch_task(convert_batch_pdf, docx_path)
+        pending.append((docx_path, original_filename, pdf_future))
+        if len(pending) >= window:
+            yield from entries_for(*pending.popleft())
+
+    while pending:
+        yield from entries_for(*pending.popleft())
+
+# Bulk mail-merge - one template, many rows of user data
+def parse_bulk_rows(file, mapping=None):
+    """Parse an uploaded CSV or JSONL file into input dicts keyed by placeholder base name.
+
+    mapping optionally renames columns to base names. Returns (rows, errors), where rows is a
+    list of (row_number, inputs) and errors a list of (row_number, message) for unreadable rows.
+    """
+    mapping = mapping or {}
+    text = io.TextIOWrapper(file.stream, encoding='utf-8-sig')
+    rows, errors = [], []
+
+    if file.filename.lower().endswith('.jsonl'):
+        records = []
+        for row_num, line in enumerate(text, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("expected a JSON object")
+                records.append((row_num, record))
+            except ValueError as e:
+                errors.append((row_num, f"Invalid JSON: {str(e)}"))
+    else:
+        records = enumerate(csv.DictReader(text), start=1)
+
+    for row_num, record in records:
+        inputs = {}
+        for column, value in record.items():
+            if column is None:
+                continue
+            inputs[mapping.get(column, column).strip()] = '' if value is None else str(value)
+        rows.append((row_num, inputs))
+    return rows, errors
+
+def render_bulk_document(snapshot, user_inputs):
+    """Worker: render one bulk row to DOCX bytes. Never touches the database or disk.
+
+    Returns (docx_bytes, stage timings).
+    """
+    with app.app_context(), collect_stage_timings() as timings:
+        data = DocumentProcessor.render_document(snapshot, user_inputs).getvalue()
+    return data, timings
+
+def bulk_zip_entries(snapshot, rows, parse_errors):
+    """Validate and render rows in parallel, yielding ZIP entries in row order and a final report."""
+    started = time.perf_counter()
+    window = max(1, app.config['BATCH_WORKERS'] * 2)  # bounded in-flight renders keep memory flat
+    errors = [{'row': row_num, 'errors': [message]} for row_num, message in parse_errors]
+    pending = deque()
+    generated = 0
+
+    def finish(row_num, user_inputs, future):
+        try:
+            data, timings = future.result()
+        except Exception as e:
+            logger.error(f"Bulk row {row_num} failed: {str(e)}")
+            errors.append({'row': row_num, 'errors': [str(e)]})
+            return None
+        observe_stage_timings(timings)
+        return f"{row_num:05d}_{DocumentProcessor.build_filename(snapshot, user_inputs)}", data
+
+    validator = DocumentProcessor.form_validator(snapshot)  # patterns compiled once for every row
+    for row_num, user_inputs in rows:
+        validation_errors = validator.validate(user_inputs)
+        if validation_errors:
+            errors.append({'row': row_num, 'errors': validation_errors})
+            continue
+        pending.append((row_num, user_inputs, submit_batch_task(render_bulk_document, snapshot, user_inputs)))
+        while len(pending) >= window:
+            entry = finish(*pending.popleft())
+            if entry:
+                generated += 1
+                yield entry
+
+    while pending:
+        entry = finish(*pending.popleft())
+        if entry:
+            generated += 1
+            yield entry
+
+    elapsed = time.perf_counter() - started
+    report = {
+        'template_id': snapshot.id,
+        'total_rows': len(rows) + len(parse_errors),
+        'generated': generated,
+        'failed': len(errors),
+        'elapsed_seconds': round(elapsed, 3),
+        'documents_per_second': round(generated / elapsed, 2) if elapsed else None,
+        'errors': sorted(errors, key=lambda e: e['row']),
+    }
+    logger.info(f"Bulk generation for template {snapshot.id}: {generated} documents, "
+                f"{len(errors)} failed rows, {report['documents_per_second']} docs/s")
+    yield 'report.json', json.dumps(report, indent=2)
+
+# Keyset pagination - pages are positioned by the last row seen, not an OFFSET, and never COUNT the table
+class KeysetPage:
+    """One newest-first page of rows with opaque cursors for the neighbouring pages."""
+
+    def __init__(self, items, prev_cursor=None, next_cursor=None):
+        self.items = items
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+def encode_cursor(row):
+    return base64.urlsafe_b64encode(f"{row.created_at.isoformat()}|{row.id}".encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """(created_at, id) from a cursor, or None if it is missing or malformed."""
+    if not cursor:
+        return None
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode().split('|')
+        return datetime.fromisoformat(created_at), int(row_id)
+    except ValueError:
+        return None
+
+def keyset_paginate(query, model, after=None, before=None, per_page=10):
+    """Page through query newest first by (created_at, id), the rows after or before a cursor.
+
+    Each page reads per_page + 1 rows from the created_at index, so its cost does not
+    grow with the size of the table. An invalid cursor gives the first page.
+    """
+    key = db.tuple_(model.created_at, model.id)
+    before_key, after_key = decode_cursor(before), decode_cursor(after)
+    if before_key:
+        # Walk up towards newer rows, then flip back to newest first
+        rows = query.filter(key > before_key).order_by(model.created_at.asc(), model.id.asc()) \
+                    .limit(per_page + 1).all()
+        if not rows:
+            return keyset_paginate(query, model, per_page=per_page)
+        newer = len(rows) > per_page
+        rows = rows[:per_page][::-1]
+        return KeysetPage(rows, encode_cursor(rows[0]) if newer else None, encode_cursor(rows[-1]))
+
+    if after_key:
+        query = query.filter(key < after_key)
+    rows = query.order_by(model.created_at.desc(), model.id.desc()).limit(per_page + 1).all()
+    older = len(rows) > per_page
+    rows = rows[:per_page]
+    return KeysetPage(rows,
+                      encode_cursor(rows[0]) if after_key and rows else None,
+                      encode_cursor(rows[-1]) if older else None)
+
 # User Routes
+def index_cache_key(*args, **kwargs):
+    """One homepage entry per query string, orphaned when documents or templates change."""
+    query = urlencode(sorted(request.args.items(multi=True)))
+    return cache_tags.key(f'view/index?{query}', 'documents', 'templates')
+
 @app.route('/')
-@cache.cached(timeout=30)  # Cache for 30 seconds to improve performance
+@cache.cached(timeout=30, make_cache_key=index_cache_key)  # Cache each page/filter for 30 seconds to improve performance
 def index():
-    page = request.args.get('page', 1, type=int)
     type_filter = request.args.get('type', '')
     
     # Optimized template query with minimal data loading
@@ -760,37 +2677,27 @@ def index():
         query = query.filter_by(type=type_filter)
     
     # Cached template types for filter dropdown
-    types = cache.get('template_types')
+    types_key = cache_tags.key('template_types', 'templates')
+    types = cache.get(types_key)
     if types is None:
         types = [t[0] for t in db.session.query(Template.type).distinct().all()]
-        cache.set('template_types', types, timeout=300)  # Cache for 5 minutes
+        cache.set(types_key, types, timeout=300)  # Cache for 5 minutes
     
     # Only load essential template fields for listing
     templates = query.with_entities(Template.id, Template.name, Template.type, Template.description).all()
     
-    # Paginated recent documents with limit
-    recent_docs = CreatedDocument.query.order_by(CreatedDocument.created_at.desc()).paginate(
-        page=page, per_page=10, error_out=False
-    )
+    # Recent documents, one keyset page at a time
+    recent_docs = keyset_paginate(CreatedDocument.query, CreatedDocument,
+                                  after=request.args.get('after'), before=request.args.get('before'), per_page=10)
     
-    return render_template('index.html', types=types, templates=templates, 
-                         recent_docs=recent_docs, page=page, total_pages=recent_docs.pages)
+    return render_template('index.html', types=types, templates=templates, recent_docs=recent_docs)
 
 @app.route('/create/<int:template_id>')
 def create(template_id):
-    template = Template.query.get_or_404(template_id)
+    template = snapshot_cache.get_or_404(template_id)
     if not template.is_active:
         abort(403)
-    placeholders = Placeholder.query.filter_by(template_id=template_id).order_by(Placeholder.sort_order).all()
-    merged_placeholders = defaultdict(list)
-    for ph in placeholders:
-        merged_placeholders[ph.name.split('_instance_')[0] if '_instance_' in ph.name else ph.name].append(ph)
-    unique_placeholders = []
-    for base_name in sorted(merged_placeholders, key=lambda n: min(p.sort_order for p in merged_placeholders[n])):
-        first_ph = min(merged_placeholders[base_name], key=lambda p: p.sort_order)
-        first_ph.name = base_name  # Use base name for form
-        unique_placeholders.append(first_ph)
-    return render_template('create.html', template=template, placeholders=unique_placeholders)
+    return render_template('create.html', template=template, placeholders=DocumentProcessor.form_schema(template))
 
 @app.route('/generate', methods=['POST'])
 def generate():
@@ -800,23 +2707,90 @@ def generate():
         flash('Invalid template ID', 'error')
         return redirect(url_for('index'))
     format = request.form['format']
-    user_inputs = {k: v for k, v in request.form.items() if k not in ['template_id', 'format']}
+    user_inputs = {k: v for k, v in request.form.items() if k not in ['template_id', 'format', 'save_history']}
+
+    # History is kept unless the form explicitly opts out
+    save_history = request.form.getlist('save_history')
+    save_history = not save_history or '1' in save_history
 
     # Extract user identification from inputs
     user_name = user_inputs.get('name', 'Anonymous User')
     user_email = user_inputs.get('email', None)
 
     try:
+        if app.config['EPHEMERAL_GENERATION']:
+            # Render and stream from memory; only a wanted history record is written, in the background
+            if format not in ('docx', 'pdf'):
+                abort(400)
+            # Without history nothing of the document may outlive the response, cached copies included
+            template, stream, original_filename = DocumentProcessor.generate_ephemeral(
+                template_id, user_inputs, format, store=save_history)
+            if save_history:
+                docx_bytes = stream.getvalue() if format == 'docx' else \
+                    DocumentProcessor.render_artifact(template, user_inputs, 'docx')
+                background_executor.submit(persist_generated_document, template_id, docx_bytes,
+                                           user_inputs, user_name, user_email, original_filename,
+                                           artifact_cache.key(template, user_inputs))
+            if format == 'docx':
+                return send_file(stream, as_attachment=True, download_name=original_filename,
+                                 mimetype='application/vnd.openxmlformats-officedocument.wordprocessingml.document')
+            return send_file(stream, as_attachment=True, download_name=original_filename.replace('.docx', '.pdf'),
+                             mimetype='application/pdf')
+
         doc = DocumentProcessor.generate_document(template_id, user_inputs, user_name, user_email)
         output_path = os.path.join(app.config['GENERATED_FOLDER'], doc.file_path)
         if format == 'docx':
             return send_file(output_path, as_attachment=True, download_name=doc.original_filename)
         elif format == 'pdf':
-            pdf_path = DocumentProcessor.convert_to_pdf(output_path)
+            pdf_path = output_path.replace('.docx', '.pdf')
+            with open(pdf_path, 'wb') as f:
+                f.write(DocumentProcessor.render_artifact(snapshot_cache.get_or_404(template_id), user_inputs, 'pdf'))
             return send_file(pdf_path, as_attachment=True, download_name=doc.original_filename.replace('.docx', '.pdf'))
     except ValueError as e:
         flash(str(e), 'error')
         return redirect(url_for('create', template_id=template_id))
+    except PdfConversionError:
+        flash('The document could not be converted to PDF. Please download it as DOCX instead.', 'error')
+        return redirect(url_for('create', template_id=template_id))
+
+@app.route('/bulk/<int:template_id>', methods=['GET', 'POST'])
+def bulk(template_id):
+    """Mail-merge a CSV/JSONL upload against one template into a streamed ZIP."""
+    template = snapshot_cache.get_or_404(template_id)
+    if not template.is_active:
+        abort(403)
+
+    if request.method == 'GET':
+        base_names = [field['name'] for field in DocumentProcessor.form_schema(template)]
+        return render_template('bulk.html', template=template, base_names=base_names)
+
+    file = request.files.get('file')
+    if not file or not file.filename.lower().endswith(('.csv', '.jsonl')):
+        flash('Please upload a .csv or .jsonl file', 'error')
+        return redirect(url_for('bulk', template_id=template_id))
+
+    try:
+        mapping = json.loads(request.form.get('mapping') or '{}')
+        if not isinstance(mapping, dict):
+            raise ValueError("mapping must be a JSON object")
+        if not all(isinstance(k, str) and isinstance(v, str) for k, v in mapping.items()):
+            raise ValueError("columns must map to placeholder names given as strings")
+    except ValueError as e:
+        flash(f'Invalid column mapping: {str(e)}', 'error')
+        return redirect(url_for('bulk', template_id=template_id))
+
+    try:
+        rows, parse_errors = parse_bulk_rows(file, mapping)
+    except (UnicodeDecodeError, csv.Error) as e:
+        flash(f'Could not read {file.filename}: {str(e)}', 'error')
+        return redirect(url_for('bulk', template_id=template_id))
+
+    logger.info(f"Bulk generation for template {template_id}: {len(rows)} rows from {file.filename}")
+    zip_filename = f"bulk_{secure_filename(template.name)}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    entries = bulk_zip_entries(template, rows, parse_errors)
+    return Response(stream_zip(entries), mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="{zip_filename}"',
+                             'X-Bulk-Rows': str(len(rows) + len(parse_errors))})
 
 @app.route('/results/<int:document_id>')
 def results(document_id):
@@ -830,12 +2804,18 @@ def download(document_id, format):
     if not os.path.exists(docx_path):
         abort(404)
 
+    storage_reaper.touch(docx_path)
+
     if format == 'docx':
         return send_file(docx_path, as_attachment=True, download_name=document.original_filename)
     elif format == 'pdf':
         pdf_path = docx_path.replace('.docx', '.pdf')
         if not os.path.exists(pdf_path):
-            DocumentProcessor.convert_to_pdf(docx_path)
+            try:
+                DocumentProcessor.convert_to_pdf(docx_path, template=document.template)
+            except PdfConversionError:
+                flash('The document could not be converted to PDF. Please download it as DOCX instead.', 'error')
+                return redirect(url_for('results', document_id=document_id))
         return send_file(pdf_path, as_attachment=True, download_name=document.original_filename.replace('.docx', '.pdf'))
     abort(400)
 
@@ -864,10 +2844,13 @@ def batch():
             logger.info(f"Starting batch processing for {len(template_ids)} templates with user: {user_name}")
             logger.info(f"User inputs: {list(user_inputs.keys())}")
             
-            batch, docs = process_batch(template_ids, user_inputs, user_name, user_email)
-            
-            logger.info(f"Batch processing completed. Batch ID: {batch.batch_id}, Documents: {len(docs)}")
-            flash(f'Batch generated successfully! {len(docs)} documents created.', 'success')
+            # A profiled request also profiles the queued job, where the rendering actually happens
+            profile_id = f"{g.profile_id}-job" if g.get('profiler') else None
+            batch = enqueue_batch(template_ids, user_inputs, user_name, user_email,
+                                  profile_id, g.get('profile_trigger'))
+
+            logger.info(f"Batch queued. Batch ID: {batch.batch_id}, Documents: {batch.total_documents}")
+            flash(f'Batch queued! {batch.total_documents} documents are being generated.', 'success')
             
             return redirect(url_for('batch_results', batch_id=batch.batch_id))
             
@@ -889,29 +2872,24 @@ def get_merged_placeholders():
     template_ids = request.json['template_ids']
     logger.info(f"Getting merged placeholders for templates: {template_ids}")
     
-    merged_placeholders = defaultdict(list)
-    min_sort_order = {}
-    
+    merged_fields = {}
+    templates = snapshot_cache.get_many(template_ids)
     for tid in template_ids:
-        placeholders = Placeholder.query.filter_by(template_id=tid).all()
-        logger.info(f"Template {tid} has {len(placeholders)} placeholders")
-        
-        for ph in placeholders:
-            # Extract base name from instance ID (e.g., "name_instance_1" -> "name")
-            base_name = ph.name.split('_instance_')[0] if '_instance_' in ph.name else ph.name
-            
-            merged_placeholders[base_name].append(ph)
-            if base_name not in min_sort_order or ph.sort_order < min_sort_order[base_name]:
-                min_sort_order[base_name] = ph.sort_order
-    
-    unique_placeholders = []
-    for name in sorted(merged_placeholders, key=lambda n: min_sort_order[n]):
-        first_ph = sorted(merged_placeholders[name], key=lambda p: p.sort_order)[0]
-        # Use the base name for the form field
-        first_ph.name = name
-        unique_placeholders.append(first_ph)
-    
-    logger.info(f"Merged into {len(unique_placeholders)} unique placeholders: {[p.name for p in unique_placeholders]}")
+        template = templates.get(int(tid)) if str(tid).isdigit() else None
+        if template is None:
+            continue
+        form_schema = DocumentProcessor.form_schema(template)
+        logger.info(f"Template {tid} has {len(form_schema)} form fields")
+
+        # Fields shared by several templates keep the settings with the lowest sort order
+        for field in form_schema:
+            merged = merged_fields.get(field['name'])
+            if merged is None or field['sort_order'] < merged['sort_order']:
+                merged_fields[field['name']] = field
+
+    unique_placeholders = sorted(merged_fields.values(), key=lambda f: f['sort_order'])
+
+    logger.info(f"Merged into {len(unique_placeholders)} unique placeholders: {[f['name'] for f in unique_placeholders]}")
     return render_template('partials/form_fields.html', placeholders=unique_placeholders)
 
 @app.route('/batch_results/<string:batch_id>')
@@ -920,66 +2898,83 @@ def batch_results(batch_id):
     documents = CreatedDocument.query.filter_by(batch_id=batch_id).all()
     return render_template('batch_results.html', batch=batch, documents=documents)
 
+@app.route('/batch_status/<string:batch_id>')
+def batch_status(batch_id):
+    """JSON progress of a batch, polled by batch_results.html."""
+    batch = BatchGeneration.query.filter_by(batch_id=batch_id).first_or_404()
+    if batch.status == 'processing':
+        # The worker running it may have died since startup; polling is what notices
+        recover_batch(batch)
+    return jsonify({
+        'batch_id': batch.batch_id,
+        'status': batch.status,
+        'total_documents': batch.total_documents,
+        'successful_documents': batch.successful_documents,
+        'completed_at': batch.completed_at.isoformat() if batch.completed_at else None,
+        'error_message': batch.error_message,
+        'done': batch.completed_at is not None or batch.status == 'failed',
+    })
+
 @app.route('/batch_download/<string:batch_id>')
 def batch_download(batch_id):
-    """Download all documents from a batch as a ZIP file."""
+    """Stream all documents from a batch as a ZIP file.
+
+    Query args: compression (0-9, default ZIP_COMPRESSION_LEVEL) and pdf=1 to
+    convert and include PDFs that have not been generated yet.
+    """
     batch = BatchGeneration.query.filter_by(batch_id=batch_id).first_or_404()
     documents = CreatedDocument.query.filter_by(batch_id=batch_id).all()
-    
+
     if not documents:
         flash('No documents found in this batch.', 'error')
         return redirect(url_for('batch_results', batch_id=batch_id))
-    
-    try:
-        # Create a ZIP file in memory
-        zip_buffer = io.BytesIO()
-        with ZipFile(zip_buffer, 'w') as zip_file:
-            for doc in documents:
-                docx_path = os.path.join(app.config['GENERATED_FOLDER'], doc.file_path)
-                if os.path.exists(docx_path):
-                    # Add DOCX file to ZIP
-                    zip_file.write(docx_path, doc.original_filename)
-                    
-                    # Also add PDF version if it exists
-                    pdf_path = docx_path.replace('.docx', '.pdf')
-                    if os.path.exists(pdf_path):
-                        pdf_filename = doc.original_filename.replace('.docx', '.pdf')
-                        zip_file.write(pdf_path, pdf_filename)
-        
-        zip_buffer.seek(0)
-        
-        # Send the ZIP file
-        zip_filename = f"batch_{batch_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
-        return send_file(
-            zip_buffer,
-            as_attachment=True,
-            download_name=zip_filename,
-            mimetype='application/zip'
-        )
-        
-    except Exception as e:
-        logger.error(f"Error creating batch download: {str(e)}")
-        flash('Error creating batch download. Please try downloading documents individually.', 'error')
-        return redirect(url_for('batch_results', batch_id=batch_id))
+
+    # Resolve paths now; the archive itself is written after the request context is gone
+    files = []
+    for doc in documents:
+        docx_path = os.path.join(app.config['GENERATED_FOLDER'], doc.file_path)
+        if os.path.exists(docx_path):
+            storage_reaper.touch(docx_path)
+            files.append((docx_path, doc.original_filename))
+
+    level = request.args.get('compression', app.config['ZIP_COMPRESSION_LEVEL'], type=int)
+    include_pdfs = request.args.get('pdf', '0') == '1'
+
+    zip_filename = f"batch_{batch_id}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    return Response(stream_zip(batch_zip_entries(files, include_pdfs), **zip_compression(level)),
+                    mimetype='application/zip',
+                    headers={'Content-Disposition': f'attachment; filename="{zip_filename}"'})
 
 @app.route('/admin')
 def admin():
     key = request.args.get('key')
     if key != app.config['ADMIN_KEY']:
         abort(403)
-    stats = {
-        'templates': Template.query.count(),
-        'active_templates': Template.query.filter_by(is_active=True).count(),
-        'total_documents': CreatedDocument.query.count(),
-        'total_batches': BatchGeneration.query.count(),
-    }
-    return render_template('admin.html', stats=stats, admin_key=key)
+    return render_template('admin.html', stats=admin_stats(), admin_key=key)
+
+def admin_stats():
+    """Dashboard counts from one aggregate query, cached for ADMIN_STATS_TIMEOUT seconds."""
+    key = cache_tags.key('admin_stats', 'templates', 'documents')
+    stats = cache.get(key)
+    if stats is None:
+        def count(model, *criteria):
+            return db.select(db.func.count()).select_from(model).where(*criteria).scalar_subquery()
+
+        row = db.session.execute(db.select(
+            count(Template).label('templates'),
+            count(Template, Template.is_active.is_(True)).label('active_templates'),
+            count(CreatedDocument).label('total_documents'),
+            count(BatchGeneration).label('total_batches'),
+        )).one()
+        stats = dict(row._mapping)
+        cache.set(key, stats, timeout=app.config['ADMIN_STATS_TIMEOUT'])
+    return stats
+
 @app.route('/admin/templates')
 def admin_templates():
     key = request.args.get('key')
     if key != app.config['ADMIN_KEY']:
         abort(403)
-    page = request.args.get('page', 1, type=int)
     search = request.args.get('search', '')
 
     query = Template.query
@@ -992,9 +2987,8 @@ def admin_templates():
             )
         )
 
-    templates = query.order_by(Template.created_at.desc()).paginate(
-        page=page, per_page=20, error_out=False
-    )
+    templates = keyset_paginate(query, Template, after=request.args.get('after'),
+                                before=request.args.get('before'), per_page=20)
 
     return render_template('admin/templates.html',
                            templates=templates,
@@ -1023,39 +3017,33 @@ def admin_upload_template():
         # Save file with unique name
         filename = secure_filename(file.filename)
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        unique_filename = f"{timestamp}_{filename}"
+        unique_filename = f"{timestamp}_{uuid.uuid4().hex[:8]}_{filename}"
         file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
         file.save(file_path)
 
-        # Create template record
+        # One pass over the DOCX for document-level styles and ALL placeholder instances
+        try:
+            placeholder_instances, styles = DocumentProcessor.analyze_template(file_path)
+        except Exception:
+            os.remove(file_path)
+            raise
+
+        # Create template record with its styles; flush only to get the id
         template = Template(
             name=name,
             type=template_type,
             description=description,
-            file_path=unique_filename
+            file_path=unique_filename,
+            **{k: v for k, v in styles.items() if v is not None or k == 'default_line_spacing'}
         )
         db.session.add(template)
-        db.session.commit()
-
-        # Extract document-level styles
-        doc = Document(file_path)
-        section = doc.sections[0]
-        template.margin_top = section.top_margin.inches
-        template.margin_bottom = section.bottom_margin.inches
-        template.margin_left = section.left_margin.inches
-        template.margin_right = section.right_margin.inches
-        template.default_line_spacing = doc.paragraphs[0].paragraph_format.line_spacing if doc.paragraphs else 1.0
-        
-        # Use dominant font and size for better accuracy across the entire document
-        template.font_family, template.font_size = DocumentProcessor.get_dominant_font_and_size(doc)
-
-        # Extract ALL placeholder instances with formatting
-        placeholder_instances = DocumentProcessor.extract_template_variables(file_path)
+        db.session.flush()
 
-        # Create placeholders with instance numbering for multiples
+        # Create placeholders with instance numbering for multiples, inserted in one statement
         instance_counters = Counter()
-        i = 0
-        for inst in placeholder_instances:
+        smart_field_rules.refresh()  # pick up admin edits to the rules file
+        rows = []
+        for i, inst in enumerate(placeholder_instances):
             var_name = inst['name']
             instance_counters[var_name] += 1
             if instance_counters[var_name] == 1:
@@ -1063,46 +3051,47 @@ def admin_upload_template():
             else:
                 instance_name = f"{var_name}_instance_{instance_counters[var_name]}"
             base_name = var_name
-            var_type = DocumentProcessor.detect_variable_type(base_name)
+            smart = smart_field_rules.resolve(base_name)  # type, default, help text and options in one scan
             formatting = inst['formatting']
-            placeholder_text = DocumentProcessor.get_smart_placeholder_default(base_name)
-            help_text = DocumentProcessor.get_smart_help_text(base_name)
             display_name = base_name.replace('_', ' ').title()
             if instance_counters[var_name] > 1:
                 display_name += f" (Instance {instance_counters[var_name]})"
-            placeholder = Placeholder(
+            rows.append(dict(
                 template_id=template.id,
                 name=instance_name,
+                base_name=base_name,
                 display_name=display_name,
-                placeholder_type=var_type,
+                placeholder_type=smart.type,
                 sort_order=i,
-                help_text=help_text,
+                help_text=smart.help_text,
                 bold=formatting.get('bold', False),
                 italic=formatting.get('italic', False),
                 underline=formatting.get('underline', False),
+                casing='none',
                 font_family=formatting.get('font', template.font_family),
                 font_size=formatting.get('size', template.font_size),
                 alignment=inst['alignment'],
                 left_indent=0.0,
                 paragraph_index=inst['paragraph_index'],
                 run_index=inst['run_index'],
-                default_value=placeholder_text,
+                default_value=smart.default,
+                options=json.dumps(smart.options),
+                validation_pattern=None,
                 is_required=True
-            )
-            if var_type == 'option':
-                smart_options = DocumentProcessor.get_smart_options(base_name)
-                placeholder.options = json.dumps(smart_options)
-            else:
-                placeholder.options = json.dumps([])
-            db.session.add(placeholder)
-            i += 1
+            ))
+        if rows:
+            db.session.execute(db.insert(Placeholder), rows)
+        template.form_schema = json.dumps(
+            DocumentProcessor.build_form_schema([SimpleNamespace(**row) for row in rows]))
 
         db.session.commit()
+        invalidate_template(template.id)
 
         flash(f'Template "{name}" uploaded successfully with {len(placeholder_instances)} placeholders', 'success')
         return redirect(url_for('admin_edit_template', template_id=template.id, key=key))
 
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Error uploading template: {str(e)}")
         flash(f'Error uploading template: {str(e)}. Please try again.', 'error')
         return redirect(url_for('admin_upload_template', key=key))
@@ -1136,6 +3125,7 @@ def admin_edit_template(template_id):
             return redirect(url_for('admin_edit_template', template_id=template_id, key=key))
         template.updated_at = datetime.now(timezone.utc)
 
+        invalid_patterns = []
         for placeholder in template.placeholders:
             prefix = f'{placeholder.id}_'
             placeholder.display_name = request.form.get(prefix + 'display_name', placeholder.name)
@@ -1147,10 +3137,22 @@ def admin_edit_template(template_id):
             placeholder.underline = prefix + 'underline' in request.form
             placeholder.casing = request.form.get(prefix + 'casing', 'none')
             placeholder.default_value = request.form.get(prefix + 'placeholder', '')
+            placeholder.validation_pattern = request.form.get(prefix + 'validation', '').strip() or None
+            if placeholder.validation_pattern:
+                try:
+                    re.compile(placeholder.validation_pattern)
+                except re.error as e:
+                    invalid_patterns.append(f"{placeholder.display_name or placeholder.name}: {str(e)}")
             if placeholder.placeholder_type == 'option':
                 placeholder.options = json.dumps(request.form.getlist(prefix + 'options'))
+        if invalid_patterns:
+            db.session.rollback()
+            flash('Invalid validation pattern - ' + '; '.join(invalid_patterns), 'error')
+            return redirect(url_for('admin_edit_template', template_id=template_id, key=key))
+        template.form_schema = json.dumps(DocumentProcessor.build_form_schema(template.placeholders))
 
         db.session.commit()
+        invalidate_template(template_id)
 
         flash('Template updated successfully', 'success')
         return redirect(url_for('admin_templates', key=key))
@@ -1168,6 +3170,7 @@ def admin_pause_template(template_id):
     template = Template.query.get_or_404(template_id)
     template.is_active = False
     db.session.commit()
+    invalidate_template(template_id)
     flash('Template paused', 'success')
     return redirect(url_for('admin_templates', key=key))
 
@@ -1179,6 +3182,7 @@ def admin_resume_template(template_id):
     template = Template.query.get_or_404(template_id)
     template.is_active = True
     db.session.commit()
+    invalidate_template(template_id)
     flash('Template resumed', 'success')
     return redirect(url_for('admin_templates', key=key))
 
@@ -1192,8 +3196,13 @@ def admin_delete_template(template_id):
         os.remove(os.path.join(app.config['UPLOAD_FOLDER'], template.file_path))
     except:
         pass
+    artifact_keys = db.session.execute(db.select(CreatedDocument.artifact_key).where(
+        CreatedDocument.template_id == template_id, CreatedDocument.artifact_key.is_not(None))).scalars().all()
     db.session.delete(template)
     db.session.commit()
+    invalidate_template(template_id)
+    for artifact_key in artifact_keys:
+        artifact_cache.discard(artifact_key)
     flash('Template deleted', 'success')
     return redirect(url_for('admin_templates', key=key))
 
@@ -1222,6 +3231,9 @@ def admin_clear_database():
         
         # Clear all caches
         cache.clear()
+        snapshot_cache.clear()
+        template_cache.clear()
+        artifact_cache.clear()
         
         flash('Database and all files cleared successfully! Starting fresh.', 'success')
         logger.info("Database and files cleared by admin")
@@ -1232,6 +3244,28 @@ def admin_clear_database():
     
     return redirect(url_for('admin', key=key))
 
+@app.route('/admin/storage/sweep')
+def admin_sweep_storage():
+    """Run a storage sweep now instead of waiting for STORAGE_SWEEP_INTERVAL."""
+    key = request.args.get('key')
+    if key != app.config['ADMIN_KEY']:
+        abort(403)
+
+    try:
+        result = storage_reaper.sweep()
+        if result is None:
+            flash('A storage sweep is already running in another worker.', 'warning')
+        else:
+            flash(f"Storage cleaned up: {result['orphans']} orphaned, {result['expired']} expired and "
+                  f"{result['evicted']} evicted documents removed, "
+                  f"{result['bytes_freed'] / (1024 * 1024):.1f} MB freed.", 'success')
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Error sweeping storage: {str(e)}")
+        flash(f'Error sweeping storage: {str(e)}', 'error')
+
+    return redirect(url_for('admin', key=key))
+
 @app.route('/admin/database/backup')
 def admin_backup_database():
     """Create a backup of the database"""
@@ -1266,38 +3300,88 @@ def admin_backup_database():
 @app.route('/delete/<int:document_id>')
 def delete_document(document_id):
     doc = CreatedDocument.query.get_or_404(document_id)
-    
-    # Background file deletion - don't wait for file operations
-    try:
-        docx_path = os.path.join(app.config['GENERATED_FOLDER'], doc.file_path)
-        pdf_path = doc.file_path.replace('.docx', '.pdf')
-        pdf_full_path = os.path.join(app.config['GENERATED_FOLDER'], pdf_path)
-        
-        # Delete files in background to avoid blocking the UI
-        import threading
-        def delete_files():
-            try:
-                if os.path.exists(docx_path):
-                    os.remove(docx_path)
-                if os.path.exists(pdf_full_path):
-                    os.remove(pdf_full_path)
-            except:
-                pass
-        
-        threading.Thread(target=delete_files, daemon=True).start()
-    except:
-        pass
-    
+    file_path, artifact_key = doc.file_path, doc.artifact_key
+
     # Immediate database deletion
     db.session.delete(doc)
     db.session.commit()
-    
-    # Clear homepage cache to update immediately
-    cache.clear()
+
+    # The reaper thread removes the files, so the UI doesn't wait on the disk
+    storage_reaper.discard(file_path)
+    artifact_cache.discard(artifact_key)
+
+    # Evict the cached homepage pages so the list updates immediately
+    cache_tags.invalidate('documents')
     
     flash('Document deleted successfully', 'success')
     return redirect(url_for('index'))
 
+@app.route('/metrics')
+def metrics():
+    """Prometheus scrape endpoint: per-stage generation timings for this process."""
+    if not app.config['METRICS_ENABLED']:
+        abort(404)
+    return Response(stage_metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.after_request
+def add_server_timing(response):
+    """Report this request's stage timings in a Server-Timing header, if enabled."""
+    timings = g.get('stage_timings')
+    if timings and app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = ', '.join(
+            f'{stage};dur={seconds * 1000:.2f}' for stage, seconds in timings.items())
+    return response
+
+@app.before_request
+def start_storage_reaper():
+    storage_reaper.ensure_started()
+
+@app.before_request
+def start_request_profile():
+    """Profile this request if the admin key holder asked for it or it was sampled."""
+    trigger = request_profiler.trigger()
+    if trigger:
+        g.profile_trigger = trigger
+        g.profile_id = uuid.uuid4().hex
+        g.profile_started = time.perf_counter()
+        g.profiler = request_profiler.start()
+
+@app.after_request
+def finish_request_profile(response):
+    """Store this request's profile and tell the caller its id in X-Profile-Id."""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        request_profiler.save(g.profile_id, profiler, time.perf_counter() - g.profile_started,
+                              endpoint=request.endpoint, method=request.method, path=request.path,
+                              status=response.status_code, trigger=g.profile_trigger,
+                              stages=g.get('stage_timings', {}))
+        response.headers['X-Profile-Id'] = g.profile_id
+    return response
+
+@app.teardown_request
+def stop_request_profile(exception=None):
+    """Make sure a request that failed before after_request leaves no profiler running."""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+
+@app.route('/admin/profiles')
+def admin_profiles():
+    key = request.args.get('key')
+    if key != app.config['ADMIN_KEY']:
+        abort(403)
+    return render_template('admin/profiles.html', profiles=request_profiler.slowest(), admin_key=key)
+
+@app.route('/admin/profiles/<string:profile_id>')
+def admin_download_profile(profile_id):
+    """The raw .prof file (for pstats or snakeviz), or ?format=txt for a cumulative-time report."""
+    key = request.args.get('key')
+    if key != app.config['ADMIN_KEY']:
+        abort(403)
+    if request.args.get('format') == 'txt':
+        return Response(request_profiler.report(profile_id), mimetype='text/plain')
+    return send_file(request_profiler.path(profile_id), as_attachment=True, download_name=f'{profile_id}.prof')
+
 # Error Handlers
 @app.errorhandler(404)
 def not_found_error(error):
@@ -1313,8 +3397,43 @@ def internal_error(error):
 # ... (rest of the admin routes remain the same as in your original file)
 
 # Initialize Database
-with app.app_context():
-    db.create_all()
+def migrate_database():
+    """Bring an existing database up to the current models; create_all only adds missing tables."""
+    inspector = db.inspect(db.engine)
+    added_columns = [
+        ('placeholder', 'base_name', 'VARCHAR(100)'),
+        ('template', 'form_schema', 'TEXT'),
+        ('batch_generation', 'updated_at', 'TIMESTAMP'),
+        ('created_document', 'artifact_key', 'VARCHAR(64)'),
+    ]
+    for table, column, ddl in added_columns:
+        if column not in {c['name'] for c in inspector.get_columns(table)}:
+            logger.info(f"Adding column {table}.{column}")
+            db.session.execute(db.text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+    db.session.commit()
+
+    # create_all skips tables that already exist, indexes included
+    for table in db.metadata.sorted_tables:
+        existing = {i['name'] for i in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info(f"Creating index {index.name}")
+                index.create(bind=db.engine)
+
+    # Backfill placeholder groups for rows created before they were stored
+    for placeholder in Placeholder.query.filter(Placeholder.base_name.is_(None)):
+        placeholder.base_name = DocumentProcessor.base_name(placeholder.name)
+    for template in Template.query.options(selectinload(Template.placeholders)).filter(Template.form_schema.is_(None)):
+        template.form_schema = json.dumps(DocumentProcessor.build_form_schema(template.placeholders))
+    db.session.commit()
+
+# Batch pool workers (forkserver/spawn) import this module too; only the app process owns the
+# schema and the job queue
+if multiprocessing.parent_process() is None:
+    with app.app_context():
+        db.create_all()
+        migrate_database()
+        recover_batches()
 
 if __name__ == '__main__':
     try:
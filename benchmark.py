@@ -0,0 +1,269 @@
+"""Benchmark harness for template extraction, rendering, PDF conversion and batch throughput.
+
+Builds synthetic DOCX templates of several sizes, runs each stage of the generation
+pipeline against an isolated copy of the app (temporary database, upload, output and
+cache folders), and writes latency percentiles, throughput and peak RSS to JSON.
+
+    python benchmark.py                                  # all sizes, results in benchmark-results.json
+    python benchmark.py --sizes small medium -n 50 -o before.json
+    python benchmark.py -o after.json --compare before.json --threshold 0.2
+
+With --compare, any benchmark whose p50 latency grew by more than the threshold is
+reported and the exit status is 1, so the script can gate a CI job.
+"""
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import warnings
+from datetime import datetime, timezone
+
+# Synthetic template shapes: paragraphs of body text, distinct placeholders, and how
+# many times each placeholder appears
+SIZES = {
+    'small': {'paragraphs': 10, 'placeholders': 5, 'repeats': 2},
+    'medium': {'paragraphs': 200, 'placeholders': 20, 'repeats': 3},
+    'large': {'paragraphs': 2000, 'placeholders': 50, 'repeats': 4},
+}
+
+FILLER = ('This agreement is made between the parties named below and sets out the terms '
+          'under which the services will be provided. ')
+
+
+def build_template(paragraphs, placeholders, repeats):
+    """DOCX bytes with the given number of paragraphs and {{ field_N }} placeholders, plus a table."""
+    from docx import Document
+    from docx.shared import Pt
+
+    names = [f'field_{i}' for i in range(placeholders)]
+    occurrences = [name for name in names for _ in range(repeats)]
+    doc = Document()
+    for i in range(paragraphs):
+        paragraph = doc.add_paragraph()
+        run = paragraph.add_run(FILLER)
+        run.font.name, run.font.size = 'Times New Roman', Pt(12)
+        if i < len(occurrences):
+            placeholder = paragraph.add_run(f'{{{{ {occurrences[i]} }}}}')
+            placeholder.bold = i % 3 == 0
+        paragraph.add_run(FILLER)
+    # Placeholders that didn't fit in the body go in a table
+    leftover = occurrences[paragraphs:]
+    if leftover:
+        table = doc.add_table(rows=len(leftover), cols=2)
+        for row, name in zip(table.rows, leftover):
+            row.cells[0].text = name.replace('_', ' ').title()
+            row.cells[1].text = f'{{{{ {name} }}}}'
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue(), names
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, units=1):
+    """Latency stats in milliseconds; units is the work done per timed call (e.g. documents per batch)."""
+    values = sorted(latencies)
+    total = sum(values)
+    return {
+        'iterations': len(values),
+        'mean_ms': total / len(values) * 1000,
+        'p50_ms': percentile(values, 0.50) * 1000,
+        'p90_ms': percentile(values, 0.90) * 1000,
+        'p99_ms': percentile(values, 0.99) * 1000,
+        'min_ms': values[0] * 1000,
+        'max_ms': values[-1] * 1000,
+        'throughput_per_s': len(values) * units / total if total else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process and its finished children so far."""
+    scale = 1 if sys.platform == 'darwin' else 1024  # ru_maxrss is bytes on macOS, KiB elsewhere
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale
+    return round(max(own, children) / (1024 * 1024), 1)
+
+
+def measure(func, iterations, warmup=1):
+    """Latencies in seconds of func(i) over iterations, after unmeasured warmup calls."""
+    for i in range(warmup):
+        func(-1 - i)
+    latencies = []
+    for i in range(iterations):
+        started = time.perf_counter()
+        func(i)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def load_app(workdir, keep_artifact_cache):
+    """Import app.py against throwaway storage under workdir."""
+    os.environ.update({
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'CACHE_DIR': os.path.join(workdir, 'cache'),
+        'ARTIFACT_CACHE_DIR': os.path.join(workdir, 'artifacts'),
+        'SMART_RULES_FILE': os.path.join(workdir, 'smart_rules.json'),
+    })
+    if not keep_artifact_cache:
+        # Repeated inputs would otherwise be served from the cache instead of rendered
+        os.environ['ARTIFACT_CACHE_MAX_BYTES'] = '0'
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app as app_module
+
+    for key in ('UPLOAD_FOLDER', 'GENERATED_FOLDER', 'TEMP_FOLDER'):
+        app_module.app.config[key] = os.path.join(workdir, key.split('_')[0].lower())
+        os.makedirs(app_module.app.config[key], exist_ok=True)
+    logging.getLogger().setLevel(logging.WARNING)
+    # A batch of one template repeated gives ZIP entries with the same name
+    warnings.filterwarnings('ignore', 'Duplicate name', UserWarning)
+    return app_module
+
+
+def run_size(app_module, size, shape, args):
+    """Run every benchmark for one template size and return {benchmark: stats}."""
+    processor = app_module.DocumentProcessor
+    client = app_module.app.test_client()
+    docx_bytes, names = build_template(**shape)
+    results = {'template_bytes': len(docx_bytes)}
+
+    # Upload through the admin route, as an administrator would
+    response = client.post('/admin/upload', data={
+        'key': app_module.app.config['ADMIN_KEY'], 'name': f'Bench {size}', 'type': 'letter',
+        'file': (io.BytesIO(docx_bytes), f'bench_{size}.docx'),
+    }, content_type='multipart/form-data')
+    if response.status_code != 302:
+        raise RuntimeError(f'Template upload failed with status {response.status_code}')
+
+    with app_module.app.app_context():
+        template = app_module.Template.query.order_by(app_module.Template.id.desc()).first()
+        template_id = template.id
+        template_path = os.path.join(app_module.app.config['UPLOAD_FOLDER'], template.file_path)
+
+        def inputs(i):
+            return {name: f'{name} value {i}' for name in names} | {'name': f'Bench User {i}'}
+
+        results['extract_template_variables'] = summarize(measure(
+            lambda i: processor.extract_template_variables(template_path), args.iterations))
+
+        results['generate_document'] = summarize(measure(
+            lambda i: processor.generate_document(template_id, inputs(i), f'Bench User {i}'), args.iterations))
+
+        snapshot = app_module.snapshot_cache.get(template_id)
+        rendered = processor.render_document(snapshot, inputs(0)).getvalue()
+        results['convert_to_pdf'] = summarize(measure(
+            lambda i: processor.convert_to_pdf(io.BytesIO(rendered), template=snapshot), args.iterations))
+
+        batch_ids = []
+
+        def run_batch(i):
+            batch, _ = app_module.process_batch([template_id] * args.batch_size, inputs(i), f'Bench User {i}')
+            batch_ids.append(batch.batch_id)
+
+        results['process_batch'] = summarize(
+            measure(run_batch, max(1, args.iterations // 5)), units=args.batch_size)
+
+    download_bytes = []
+
+    def download(i):
+        response = client.get(f'/batch_download/{batch_ids[i % len(batch_ids)]}')
+        download_bytes.append(sum(len(chunk) for chunk in response.response))
+        response.close()
+
+    results['batch_download'] = summarize(measure(download, max(1, args.iterations // 5)), units=args.batch_size)
+    results['batch_download']['mean_bytes'] = sum(download_bytes) / len(download_bytes)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Benchmarks whose p50 latency regressed by more than threshold (a fraction) against baseline."""
+    regressions = []
+    for size, benchmarks in results['results'].items():
+        for name, stats in benchmarks.items():
+            old = baseline.get('results', {}).get(size, {}).get(name)
+            if not isinstance(stats, dict) or not isinstance(old, dict) or not old.get('p50_ms'):
+                continue
+            change = stats['p50_ms'] / old['p50_ms'] - 1
+            if change > threshold:
+                regressions.append(f"{size}/{name}: p50 {old['p50_ms']:.1f}ms -> {stats['p50_ms']:.1f}ms "
+                                   f"(+{change:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', nargs='+', choices=sorted(SIZES), default=list(SIZES),
+                        help='template sizes to benchmark (default: all)')
+    parser.add_argument('-n', '--iterations', type=int, default=20, help='timed iterations per benchmark')
+    parser.add_argument('--batch-size', type=int, default=10, help='documents per batch')
+    parser.add_argument('-o', '--output', default='benchmark-results.json', help='where to write results')
+    parser.add_argument('--compare', help='earlier results JSON to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='p50 slowdown, as a fraction, that counts as a regression (default: 0.25)')
+    parser.add_argument('--artifact-cache', action='store_true',
+                        help='leave the rendered-artifact cache enabled (off by default so every call renders)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='docgen-bench-')
+    try:
+        app_module = load_app(workdir, args.artifact_cache)
+        results = {
+            'meta': {
+                'commit': git_commit(),
+                'timestamp': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'batch_executor': app_module.app.config['BATCH_EXECUTOR'],
+                'batch_workers': app_module.app.config['BATCH_WORKERS'],
+                'args': vars(args),
+            },
+            'results': {},
+        }
+        for size in args.sizes:
+            print(f'Benchmarking {size} template {SIZES[size]}...', flush=True)
+            results['results'][size] = run_size(app_module, size, SIZES[size], args)
+            for name, stats in results['results'][size].items():
+                if isinstance(stats, dict):
+                    print(f"  {name:28} p50 {stats['p50_ms']:9.2f}ms  p99 {stats['p99_ms']:9.2f}ms  "
+                          f"{stats['throughput_per_s']:9.1f}/s")
+        results['peak_rss_mb'] = peak_rss_mb()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Peak RSS {results['peak_rss_mb']} MB; results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for line in regressions:
+            print(f'REGRESSION {line}')
+        if regressions:
+            sys.exit(1)
+        print(f'No regressions beyond {args.threshold:.0%} against {args.compare}')
+
+
+if __name__ == '__main__':
+    main()